@@ -7,12 +7,31 @@ This file is responsible for computing various centrality measures for a given g
 '''
 
 import random
+from functools import partial
 
 import networkx
 import numpy
 from scipy.sparse import csr_matrix
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import splu
 
-def compute_centrality(star_dict, edge_dict):
+import generator
+from utils.workerpool import worker_map
+
+#with sampled betweenness, each process is given this many batches of source stars
+BATCHES_PER_WORKER = 4
+
+#no two security seeds are within this many jumps of each other
+SEED_SPACING = 15
+
+#the security random walk stops once a step changes the weights by less than this, relative to the total weight
+WALK_TOLERANCE = 1e-4
+
+#current flow closeness solves for this many columns of the inverse laplacian at a time
+CLOSENESS_BLOCK_SIZE = 256
+
+#with samples > 0, betweenness is approximated from that many randomly chosen source stars instead of computed exactly, see sampled_betweenness_centrality
+def compute_centrality(star_dict, edge_dict, samples=0, workers=1):
     
     #build up a nx graph
     galaxy = networkx.Graph()
@@ -23,16 +42,25 @@ def compute_centrality(star_dict, edge_dict):
         for n in neighbors:
             galaxy.add_edge(v,n)
             
-    print "betweenness"
-    betweenness_map = networkx.current_flow_betweenness_centrality(galaxy)
-    betweenness_map = normalize(betweenness_map)
+    if(samples > 0):
+        print "betweenness (sampled from %d stars)"%samples
+        node_keys = star_dict.keys()
+        betweenness, standard_error = sampled_betweenness_centrality(build_adjacency(node_keys, edge_dict), samples, workers)
+        print_sampling_error(betweenness, standard_error)
+        
+        betweenness_map = normalize(dict(zip(node_keys, betweenness.tolist())))
+    else:
+        print "betweenness"
+        betweenness_map = networkx.current_flow_betweenness_centrality(galaxy)
+        betweenness_map = normalize(betweenness_map)
     
     for key, value in betweenness_map.iteritems():
         star_dict[key]['betweenness'] = value
         
     print "closeness"
-    closeness_map = networkx.current_flow_closeness_centrality(galaxy)
-    closeness_map = normalize(closeness_map)
+    node_keys = star_dict.keys()
+    closeness = current_flow_closeness_centrality(build_adjacency(node_keys, edge_dict))
+    closeness_map = normalize(dict(zip(node_keys, closeness.tolist())))
     
     for key, value in closeness_map.iteritems():
         star_dict[key]['closeness'] = value
@@ -46,17 +74,10 @@ def compute_centrality(star_dict, edge_dict):
         star_dict[key]['pagerank'] = value
 
 
-def compute_security(star_dict, edge_dict, num_seeds, num_iterations):
+#the random walk runs for at most num_iterations steps, and stops early once a step changes the weights by less than tolerance
+#(the l1 norm of the change, relative to the total weight). the walk forgets the seeds as it settles, so num_iterations still matters
+def compute_security(star_dict, edge_dict, num_seeds, num_iterations, tolerance=WALK_TOLERANCE):
     
-    #build up a nx graph
-    galaxy = networkx.Graph()
-    for v, vertex in star_dict.iteritems():
-        galaxy.add_node(v)
-    
-    for v, neighbors in edge_dict.iteritems():
-        for n in neighbors:
-            galaxy.add_edge(v,n)
-            
     #use the centrality measures already computed to find seeds
     
     #find the top 25% vertices of each centrality measure
@@ -76,26 +97,12 @@ def compute_security(star_dict, edge_dict, num_seeds, num_iterations):
     seed_pool = top_betweenness & top_closeness & top_pagerank
     print len(seed_pool)
     
-    seeds = set()
-    #loop until we have num_seeds or the seed pool is exhausted
-    while(len(seed_pool) > 0 and len(seeds) < num_seeds):
-        
-        #pick a random vertex and remove it from the seed pool
-        current_seed = random.choice(list(seed_pool))
-        seed_pool.remove(current_seed)
-        
-        #find all vertices within 10 jumps
-        close_vertices = networkx.single_source_shortest_path(galaxy, source=current_seed, cutoff=15)
-        
-        #if none of the current seeds were found within 10 jumps, add this as a seed
-        if(len(seeds.intersection(close_vertices.iterkeys())) == 0):
-            seeds.add(current_seed)
+    seeds = select_seeds(star_dict.keys(), edge_dict, seed_pool, num_seeds)
     print len(seeds)
     
     #apply the random walk algorithm, aka pagerank with alpha=1
     personalization_dict = {k: v['closeness']**10 for k,v in star_dict.iteritems()}
-    mat = networkx.google_matrix(galaxy, alpha=1, personalization=personalization_dict, nodelist=star_dict.keys())
-    mat = csr_matrix(mat)
+    mat, dangling, personalization = build_transition_matrix(star_dict.keys(), edge_dict, personalization_dict)
     
     #for the initial array, set the seeds to 1 and everything else to 0
     weight_array = numpy.empty(len(star_dict), dtype=mat.dtype)
@@ -105,8 +112,17 @@ def compute_security(star_dict, edge_dict, num_seeds, num_iterations):
             weight_array[i] = 1
             
     #iterate that shit
-    for i in xrange(num_iterations):
-        weight_array = weight_array * mat
+    #stars with no jumps send their weight to every star, in proportion to the personalization
+    transposed = mat.T.tocsr()
+    iterations = 0
+    residual = float('inf')
+    while(iterations < num_iterations and residual > tolerance):
+        new_weight_array = transposed.dot(weight_array) + weight_array[dangling].sum() * personalization
+        
+        residual = numpy.abs(new_weight_array - weight_array).sum() / weight_array.sum()
+        weight_array = new_weight_array
+        iterations += 1
+    print "random walk took %d iterations, residual=%.2e"%(iterations, residual)
         
     #create a security dict to normalize
     security_dict = {k:weight_array[i] for i, k in enumerate(star_dict.iterkeys())}
@@ -124,6 +140,177 @@ def compute_security(star_dict, edge_dict, num_seeds, num_iterations):
         v['security'] = security_dict[k]
     
     
+#pick up to num_seeds seeds from the seed pool in a random order, skipping any that are within SEED_SPACING jumps of a seed that was already picked
+def select_seeds(node_keys, edge_dict, seed_pool, num_seeds):
+    key_to_index = {k:i for i, k in enumerate(node_keys)}
+    adjacency = build_adjacency(node_keys, edge_dict)
+    
+    #go through the seed pool in a random order
+    candidates = list(seed_pool)
+    random.shuffle(candidates)
+    
+    #keep track of every vertex within SEED_SPACING jumps of a seed. a candidate can only be a seed if it isn't one of them
+    covered = numpy.zeros(len(node_keys), dtype=bool)
+    
+    seeds = set()
+    #loop until we have num_seeds or the seed pool is exhausted
+    for current_seed in candidates:
+        if(len(seeds) >= num_seeds):
+            break
+        
+        #if none of the current seeds are within SEED_SPACING jumps, add this as a seed, and mark every vertex within SEED_SPACING jumps of it
+        if(not covered[key_to_index[current_seed]]):
+            seeds.add(current_seed)
+            
+            distances = csgraph.dijkstra(adjacency, directed=False, unweighted=True, indices=key_to_index[current_seed], limit=SEED_SPACING)
+            covered |= numpy.isfinite(distances)
+            
+    return seeds
+    
+    
+#the transition matrix of a random walk along the jumps, the same as networkx.google_matrix with alpha=1, but kept sparse
+#the rows of stars with no jumps would be the personalization vector, which isn't sparse. instead this returns a mask of those stars,
+#and the normalized personalization vector, for the walk to apply separately
+def build_transition_matrix(node_keys, edge_dict, personalization_dict):
+    adjacency = build_adjacency(node_keys, edge_dict)
+    
+    #a networkx graph has a jump in both directions even if the edge dict doesn't
+    adjacency = adjacency.maximum(adjacency.T).tocsr()
+    adjacency.data[:] = 1
+    
+    degrees = numpy.diff(adjacency.indptr)
+    dangling = degrees == 0
+    
+    adjacency.data /= numpy.repeat(degrees, degrees)
+    
+    personalization = numpy.array([personalization_dict[k] for k in node_keys], dtype=numpy.float64)
+    personalization /= personalization.sum()
+    
+    return adjacency, dangling, personalization
+    
+    
+#build a CSR adjacency matrix of the galaxy, with the stars in the order of node_keys
+def build_adjacency(node_keys, edge_dict):
+    indptr, indices = generator.edge_dict_to_csr(node_keys, edge_dict)
+    return csr_matrix((numpy.ones(len(indices)), indices, indptr), shape=(len(node_keys), len(node_keys)))
+    
+    
+#approximate shortest path betweenness from a random sample of source stars, using brandes' algorithm from each source
+#exact betweenness adds up the dependency of every source on each star, so scaling the sampled sum by n / samples gives an unbiased estimate
+#returns the estimate for each star, and its standard error computed from how much the dependencies vary between sources
+def sampled_betweenness_centrality(graph, samples, workers=1):
+    num_vertices = graph.shape[0]
+    samples = min(samples, num_vertices)
+    
+    sources = numpy.random.choice(num_vertices, samples, replace=False)
+    batches = numpy.array_split(sources, max(1, min(samples, workers * BATCHES_PER_WORKER)))
+    
+    #each batch of sources is run in whichever process is free, and the results are added up afterwards
+    with worker_map(workers) as map_func:
+        results = map_func(partial(compute_dependencies, graph.indptr, graph.indices), batches)
+    
+    dependency_sum = sum(result[0] for result in results)
+    dependency_squares = sum(result[1] for result in results)
+    
+    mean = dependency_sum / samples
+    betweenness = mean * num_vertices
+    
+    #with every star as a source there's nothing left to estimate
+    if(samples == num_vertices or samples < 2):
+        standard_error = numpy.zeros(num_vertices)
+    else:
+        variance = numpy.maximum(dependency_squares / samples - mean * mean, 0) * samples / (samples - 1)
+        standard_error = numpy.sqrt(variance / samples) * num_vertices
+        
+    return betweenness, standard_error
+    
+    
+#run brandes' algorithm from each of the sources, and return the sum and the sum of squares of the dependency of the sources on each star
+#the bfs itself is done by csgraph, and the path counts and dependencies are accumulated one bfs level at a time
+def compute_dependencies(indptr, indices, sources):
+    num_vertices = len(indptr) - 1
+    graph = csr_matrix((numpy.ones(len(indices)), indices, indptr), shape=(num_vertices, num_vertices))
+    rows = numpy.repeat(numpy.arange(num_vertices), numpy.diff(indptr))
+    
+    dependency_sum = numpy.zeros(num_vertices)
+    dependency_squares = numpy.zeros(num_vertices)
+    
+    for source in sources:
+        distance = csgraph.shortest_path(graph, method='D', unweighted=True, indices=source)
+        
+        #the edges on a shortest path from the source go from one bfs level to the next
+        on_path = numpy.isfinite(distance[rows]) & (distance[indices] == distance[rows] + 1)
+        u = rows[on_path]
+        v = indices[on_path]
+        level = distance[v].astype(numpy.int64)
+        
+        #count the shortest paths to each star, going down the levels. sorting each level's edges by their end lets every star's predecessors be added up at once
+        order = numpy.lexsort((v, level))
+        u, v, level = u[order], v[order], level[order]
+        level_bounds = numpy.searchsorted(level, numpy.arange(1, level[-1] + 2)) if len(level) > 0 else [0]
+        
+        path_counts = numpy.zeros(num_vertices)
+        path_counts[source] = 1
+        for start, end in zip(level_bounds[:-1], level_bounds[1:]):
+            ends = v[start:end]
+            groups = numpy.flatnonzero(numpy.r_[True, ends[1:] != ends[:-1]])
+            path_counts[ends[groups]] = numpy.add.reduceat(path_counts[u[start:end]], groups)
+            
+        #then accumulate the dependencies going back up the levels, this time grouping each level's edges by their start
+        order = numpy.lexsort((u, level))
+        u, v = u[order], v[order]
+        
+        dependency = numpy.zeros(num_vertices)
+        for start, end in reversed(zip(level_bounds[:-1], level_bounds[1:])):
+            starts = u[start:end]
+            ends = v[start:end]
+            groups = numpy.flatnonzero(numpy.r_[True, starts[1:] != starts[:-1]])
+            dependency[starts[groups]] = numpy.add.reduceat(path_counts[starts] / path_counts[ends] * (1 + dependency[ends]), groups)
+            
+        dependency[source] = 0
+        
+        dependency_sum += dependency
+        dependency_squares += dependency * dependency
+        
+    return dependency_sum, dependency_squares
+    
+    
+#the same values as networkx.current_flow_closeness_centrality, without its O(n^2) python loop or dense intermediate results
+#the closeness of a star is 1 / the sum of the effective resistances between it and every other star. with C the inverse of the laplacian
+#grounded at any one star (with a zero row and column for that star), the sum for star v is n*C[v,v] - 2*sum(C[v]) + trace(C)
+#the grounded laplacian is factorized once, the row sums take one solve, and the diagonal is solved for in blocks of columns
+def current_flow_closeness_centrality(graph, block_size=CLOSENESS_BLOCK_SIZE):
+    num_vertices = graph.shape[0]
+    
+    if(csgraph.connected_components(graph, directed=False, return_labels=False) > 1):
+        raise ValueError("Current flow closeness needs a connected graph")
+    
+    laplacian = csgraph.laplacian(graph).tocsr()
+    solver = splu(laplacian[1:,1:].tocsc())
+    
+    row_sums = numpy.zeros(num_vertices)
+    row_sums[1:] = solver.solve(numpy.ones(num_vertices - 1))
+    
+    diagonal = numpy.zeros(num_vertices)
+    for start in xrange(0, num_vertices - 1, block_size):
+        columns = numpy.arange(start, min(start + block_size, num_vertices - 1))
+        
+        rhs = numpy.zeros((num_vertices - 1, len(columns)))
+        rhs[columns, numpy.arange(len(columns))] = 1
+        
+        diagonal[columns + 1] = solver.solve(rhs)[columns, numpy.arange(len(columns))]
+        
+    return 1.0 / (num_vertices * diagonal - 2 * row_sums + diagonal.sum())
+    
+    
+#the security pass only uses the ranking of the top 40% of stars by betweenness, so that's where the error matters
+def print_sampling_error(betweenness, standard_error):
+    top = numpy.argsort(betweenness)[-max(1, int(len(betweenness) * 0.4)):]
+    relative_error = standard_error[top] / numpy.maximum(betweenness[top], 1e-12)
+    
+    print "relative standard error of the top 40%%: median=%.3f max=%.3f"%(numpy.median(relative_error), relative_error.max())
+    
+    
 def normalize(centrality_dict):
     max_value = max(centrality_dict.itervalues())
     return {key:value/max_value for key, value in centrality_dict.iteritems()}
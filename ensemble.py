@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for generating an ensemble of many galaxies, for comparing how the generator parameters affect them
+
+Each parameter set from an ensemble config gets several members, each generated from its own seed and split into regions in its own process.
+Each member is saved to its own pickle file, along with how long it took and some statistics about its graph.
+The parameter names are the arguments of generator.generate_galaxy, see DEFAULT_PARAMETERS
+'''
+
+import os
+import time
+
+import numpy
+
+import generator
+import regions
+import serialize
+from utils import paramgrid
+
+#the parameters a parameter set can contain, and the value used when it leaves one out. these are the values the main subcommand uses
+DEFAULT_PARAMETERS = dict(
+    num_stars=5000,
+    galaxy_radius=5000,
+    spiral_arm_count=6,
+    spiral_tightness=.5,
+    disk_height=50,
+    bulge_height=150,
+    )
+
+#the columns of the summary table, see paramgrid.print_summary
+SUMMARY_COLUMNS = [
+    ('output', -20, 's', lambda result: os.path.basename(result['output'])),
+    ('seconds', 10, '.1f', lambda result: result['generate_seconds'] + result['regions_seconds']),
+    ('stars', 8, 'd', lambda result: result['stars']),
+    ('edges', 8, 'd', lambda result: result['edges']),
+    ('degree', 8, '.2f', lambda result: result['degree_mean']),
+    ('components', 12, 'd', lambda result: len(result['component_sizes'])),
+    ('regions', 8, 'd', lambda result: result['regions']['count']),
+    ('consts', 8, 'd', lambda result: result['constellations']['count']),
+    ]
+
+#generate count members for every parameter set in the config. the members are numbered in order, and member i uses the seed first_seed + i
+def run_ensemble(config, count, output_dir, workers=1, first_seed=0):
+    param_sets = [resolve_params(params) for params in paramgrid.expand_config(config)]
+
+    tasks = []
+    for params in param_sets:
+        for i in xrange(count):
+            member = len(tasks)
+            tasks.append((params, first_seed + member, os.path.join(output_dir, "member%04d.pickle"%member)))
+
+    names = paramgrid.varied_names(param_sets)
+
+    print "Generating %d galaxies on %d processes..."%(len(tasks), workers)
+
+    def describe(result):
+        return "%s finished in %.1fs: seed=%d %s"%(result['output'], result['generate_seconds'] + result['regions_seconds'], result['seed'], paramgrid.describe_params(result['params'], names))
+
+    results = paramgrid.run_tasks(run_ensemble_member, tasks, output_dir, describe, workers=workers)
+
+    paramgrid.print_summary(results, SUMMARY_COLUMNS, names)
+    return results
+
+
+#returns a copy of the parameter set with every parameter it leaves out set to its default value. raises ValueError for unknown parameters
+def resolve_params(params):
+    for name in params.iterkeys():
+        if(name not in DEFAULT_PARAMETERS):
+            raise ValueError("Unknown ensemble parameter: %s"%name)
+
+    resolved = dict(DEFAULT_PARAMETERS)
+    resolved.update(params)
+    return resolved
+
+
+def run_ensemble_member(task):
+    params, seed, output_filename = task
+
+    start_time = time.time()
+
+    #generate the arrays ourselves instead of calling generate_galaxy, so that we can look at the components before the small ones are removed
+    positions, indptr, indices = generator.generate_galaxy_arrays(seed=seed, **params)
+    _, component_sizes = generator.find_components(indptr, indices)
+
+    _, positions, indptr, indices = generator.remove_disconnected_arrays(positions, indptr, indices)
+    star_dict, edge_dict = generator.arrays_to_dicts(positions, indptr, indices)
+
+    generate_seconds = time.time() - start_time
+
+    start_time = time.time()
+    regions.compute_regions(star_dict, edge_dict)
+    regions_seconds = time.time() - start_time
+
+    serialize.save(star_dict, edge_dict, output_filename)
+
+    degrees = numpy.diff(indptr)
+    return {
+        'output': output_filename,
+        'params': params,
+        'seed': seed,
+        'generate_seconds': generate_seconds,
+        'regions_seconds': regions_seconds,
+        'stars': len(star_dict),
+        'edges': int(degrees.sum()) / 2,
+        'degree_mean': float(degrees.mean()),
+        'degree_histogram': numpy.bincount(degrees).tolist(),
+        'component_sizes': sorted(component_sizes.tolist(), reverse=True),
+        'regions': group_sizes(star_dict, 'region'),
+        'constellations': group_sizes(star_dict, 'constellation'),
+        }
+
+
+#summarize the sizes of the groups of stars that share the same value for group_key
+def group_sizes(star_dict, group_key):
+    sizes = {}
+    for star in star_dict.itervalues():
+        sizes[star[group_key]] = sizes.get(star[group_key], 0) + 1
+
+    sizes = sizes.values()
+    return {'count': len(sizes), 'min': min(sizes), 'mean': float(sum(sizes)) / len(sizes), 'max': max(sizes)}
@@ -4,246 +4,387 @@
 
 
 import math
-import random
+import os
 import pprint
 import sqlite3
+from functools import partial
+from itertools import izip
 
 import numpy
-from scipy.sparse import dok_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse import csgraph
 from scipy.optimize import brentq
 from scipy.spatial import cKDTree as KDTree
 
+import serialize
 from utils.vector3d import Vector3D
+from utils.workerpool import worker_map
 
+#each star is considered for an edge to each of its nearest NEIGHBOR_COUNT - 1 neighbors
+#the neighbor search is allowed to be off by a factor of 1 + NEIGHBOR_EPS, which is much faster
+NEIGHBOR_COUNT = 20
+NEIGHBOR_EPS = 0.1
 
-def generate_galaxy(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height):
-    
-    #generate vertices
-    star_dict = {}
-    
-    next_index = 0
-    #spiral stars
-    for i in xrange(int(num_stars*0.65)):
-        star_dict[next_index] = create_vertex_spiral(max_radius=galaxy_radius, arm_count=spiral_arm_count, beta=spiral_tightness, disk_height=disk_height)
-        next_index += 1
-    
-    #inner cluster stars
-    for i in xrange(int(num_stars*0.15)):
-        star_dict[next_index] = create_vertex_inner(max_radius=galaxy_radius * 0.8, bulge_height=bulge_height)
-        next_index += 1
+#random numbers are drawn in chunks of this many stars. changing it changes the galaxy generated by each seed
+STAR_CHUNK_SIZE = 100000
+
+#the random stream used for edges. the star populations use streams 0, 1 and 2
+EDGE_STREAM = 10
+
+#load_sqlite caches the parsed dump in a file with this appended to the dump's filename
+#the cache is ignored if the dump's size or modification time changes, or if this version number changes
+SQLITE_CACHE_EXTENSION = '.cache.npz'
+SQLITE_CACHE_VERSION = 1
+
+
+#the same seed always generates the same galaxy, no matter how many worker processes are used
+def generate_galaxy(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, seed=None, workers=1):
     
-    #outer "spread out" stars
-    while(len(star_dict) < num_stars):
-        star_dict[next_index] = create_vertex_outer(max_radius=galaxy_radius * 0.9, disk_height=disk_height)
-        next_index += 1
+    positions, indptr, indices = generate_galaxy_arrays(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, seed, workers)
     
-    #generate a KDTree from the star data in order to help with edges
-    star_keys = star_dict.keys()
-    star_values = star_dict.values()
-    star_tree = KDTree(star_values)
+    #remove disconnected components from the graph
+    _, positions, indptr, indices = remove_disconnected_arrays(positions, indptr, indices)
     
-    #compute the nearest neighbors for each vertex
-    distance_data, index_data = star_tree.query(star_values, k=20, eps=0.1)
+    return arrays_to_dicts(positions, indptr, indices)
+
+
+#convert a galaxy from arrays to the dicts used by the rest of the galaxy generator. each star is a dictionary, so other data can be added
+def arrays_to_dicts(positions, indptr, indices):
+    star_dict = {key:{'position':Vector3D(*p)} for key, p in enumerate(positions.tolist())}
+    edge_dict = csr_to_edge_dict(indptr, indices)
     
-    #for each vertex, randomly add edges to its nearest neighbors
-    edge_dict = {}
-    for distances, indexes in zip(distance_data, index_data):
-        v1 = star_keys[int(indexes[0])]
+    return star_dict, edge_dict
+
+
+#generate a galaxy as an (n,3) array of positions and a CSR adjacency: the neighbors of star i are indices[indptr[i]:indptr[i+1]]
+#this keeps every star, including ones that aren't connected to the rest of the galaxy
+def generate_galaxy_arrays(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, seed=None, workers=1):
+    if(seed is None):
+        seed = random_seed()
+    
+    #every chunk of random numbers is drawn in whichever process is free, and put back together in order
+    with worker_map(workers) as map_func:
+        #generate vertices
+        positions = sample_star_positions(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, seed, map_func)
         
-        if(v1 not in edge_dict):
-            edge_dict[v1] = set()
+        #generate a KDTree from the star data in order to help with edges
+        star_tree = KDTree(positions)
         
-        for distance, v2 in create_edges(zip(distances[1:],indexes[1:])):
-            
-            v2 = star_keys[int(v2)]
-            
-            edge_dict[v1].add(v2)
-            
-            if(v2 not in edge_dict):
-                edge_dict[v2] = set()
-            edge_dict[v2].add(v1)
-    
-    #remove disconnected components from the graph
-    star_dict, edge_dict = remove_disconnected_stars(star_dict, edge_dict)
+        #compute the nearest neighbors for each vertex. the result doesn't depend on how many threads the query is split between
+        distance_data, index_data = star_tree.query(positions, k=NEIGHBOR_COUNT, eps=NEIGHBOR_EPS, n_jobs=workers)
+        
+        indptr, indices = create_edges(distance_data, index_data, seed, map_func)
     
-    #convert the star array to an array of dictionaries before returning, so other data can be added
-    star_dict = {key:{'position':Vector3D(*p)} for key, p in star_dict.iteritems()}
+    return positions, indptr, indices
+
+
+#returns a seed for a galaxy that wasn't given one
+def random_seed():
+    return numpy.random.RandomState().randint(0, 2**31)
+
+
+#every random number is drawn from a stream identified by (seed, stream, chunk), so each chunk can be drawn separately from the others
+#and always comes out the same. each star population uses its index in star_populations as its stream
+def chunk_random_state(seed, stream, chunk):
+    return numpy.random.RandomState([seed, stream, chunk])
+
+
+#returns an (n,3) array of star positions. each population is drawn in chunks of STAR_CHUNK_SIZE stars, using map_func to draw the chunks
+def sample_star_positions(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, seed, map_func=map):
+    populations = star_populations(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height)
     
-    return star_dict, edge_dict
+    tasks = [(seed, stream, chunk, count, sample_func) for stream, chunk, count, sample_func in population_chunks(populations)]
+    return numpy.concatenate(map_func(sample_star_chunk, tasks))
+
+#split each population into chunks, returning the (stream, chunk, count, sample_func) of each chunk in order
+def population_chunks(populations):
+    chunks = []
+    for stream, (count, sample_func) in enumerate(populations):
+        for chunk, start in enumerate(xrange(0, count, STAR_CHUNK_SIZE)):
+            chunks.append((stream, chunk, min(STAR_CHUNK_SIZE, count - start), sample_func))
+    return chunks
 
-def create_vertex_inner(max_radius, bulge_height):
+def sample_star_chunk(task):
+    seed, stream, chunk, count, sample_func = task
+    return sample_func(chunk_random_state(seed, stream, chunk), count)
+
+#returns the number of stars in each population, and a function that draws a given number of stars from it: sample_func(random_state, count)
+def star_populations(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height):
+    spiral_count = int(num_stars*0.65)
+    inner_count = int(num_stars*0.15)
+    outer_count = num_stars - spiral_count - inner_count
+    
+    return [
+        (spiral_count, partial(sample_vertices_spiral, max_radius=galaxy_radius, arm_count=spiral_arm_count, beta=spiral_tightness, disk_height=disk_height)),
+        (inner_count, partial(sample_vertices_inner, max_radius=galaxy_radius * 0.8, bulge_height=bulge_height)),
+        (outer_count, partial(sample_vertices_outer, max_radius=galaxy_radius * 0.9, disk_height=disk_height)),
+        ]
+
+#inner cluster stars
+def sample_vertices_inner(random_state, count, max_radius, bulge_height):
     
-    radius_pct = random.betavariate(1.5, 4)
+    radius_pct = random_state.beta(1.5, 4, count)
     radius = radius_pct * max_radius
     
-    angle = random.uniform(0, 2 * math.pi)
-    
-    x = math.cos(angle) * radius
-    z = math.sin(angle) * radius
-    
+    angle = random_state.uniform(0, 2 * math.pi, count)
     
     max_y = bulge_height*20*radius_pct*(radius_pct - 1)**7
-    y = random.triangular(-max_y,max_y, 0)
+    y = sample_triangular(random_state, max_y)
     
-    return (x,y,z)
+    return numpy.column_stack((numpy.cos(angle) * radius, y, numpy.sin(angle) * radius))
 
-def create_vertex_outer(max_radius, disk_height):
+#outer "spread out" stars
+def sample_vertices_outer(random_state, count, max_radius, disk_height):
     
-    radius_pct = random.betavariate(2, 2)
+    radius_pct = random_state.beta(2, 2, count)
     radius = radius_pct * max_radius
     
-    angle = random.uniform(0, 2 * math.pi)
-    
-    x = math.cos(angle) * radius
-    z = math.sin(angle) * radius
+    angle = random_state.uniform(0, 2 * math.pi, count)
     
-    max_y = disk_height * math.sqrt(1 - radius_pct)
-    y = random.triangular(-max_y,max_y, 0)
+    max_y = disk_height * numpy.sqrt(1 - radius_pct)
+    y = sample_triangular(random_state, max_y)
     
-    return (x,y,z)
+    return numpy.column_stack((numpy.cos(angle) * radius, y, numpy.sin(angle) * radius))
 
-def create_vertex_spiral(max_radius, disk_height, arm_count, beta):
+#spiral stars
+def sample_vertices_spiral(random_state, count, max_radius, disk_height, arm_count, beta):
     
-    radius_pct = random.betavariate(4, 4)
+    radius_pct = random_state.beta(4, 4, count)
     radius = radius_pct * max_radius
     
-    base_angle = math.log(radius) / (beta)
+    base_angle = numpy.log(radius) / (beta)
     
-    angle_pct = random.betavariate(4, 4)
-    arm_num = random.randint(0,arm_count - 1)
+    angle_pct = random_state.beta(4, 4, count)
+    arm_num = random_state.randint(0, arm_count, count)
     arm_angle = (angle_pct + arm_num) * 2 * math.pi / arm_count
     
     angle = base_angle + arm_angle
-    x = math.cos(angle) * radius
-    z = math.sin(angle) * radius
     
-    max_y = disk_height * math.sqrt(1 - radius_pct)
-    y = random.triangular(-max_y,max_y, 0)
+    max_y = disk_height * numpy.sqrt(1 - radius_pct)
+    y = sample_triangular(random_state, max_y)
     
-    return (x,y,z)
+    return numpy.column_stack((numpy.cos(angle) * radius, y, numpy.sin(angle) * radius))
 
-def create_edges(neighbors):
-    inf = float('inf')
+#draw one value from the triangular distribution between -max_y and max_y with its peak at 0, for each value in the max_y array
+#numpy's triangular() refuses a range of width 0, so use the inverse of the distribution's CDF instead
+def sample_triangular(random_state, max_y):
+    u = random_state.uniform(0, 1, len(max_y))
     
-    for i, (distance, v) in enumerate(neighbors):
-        if(distance != inf):
-            num = random.betavariate(i + 1, 2.1)
-            
-            if(num < (0.5)):
-                yield (distance,v)
-                pass
-            
-    return
-    yield
+    #the lower half of the CDF is 2 * ((y + max_y) / 2max_y)^2, and the upper half is its mirror image
+    return numpy.where(u < 0.5, numpy.sqrt(2 * u) - 1, 1 - numpy.sqrt(2 * (1 - u))) * max_y
+
+#for each vertex, randomly add edges to its nearest neighbors. the further down the list of neighbors, the less likely an edge is
+#distance_data and index_data are the result of a KDTree query, where the first column is the vertex itself
+#returns a symmetric CSR adjacency with no duplicate edges
+def create_edges(distance_data, index_data, seed, map_func=map):
+    num_vertices, num_columns = index_data.shape
     
+    #the acceptance samples for each chunk of STAR_CHUNK_SIZE vertices come from their own stream
+    tasks = [(seed, chunk, min(STAR_CHUNK_SIZE, num_vertices - start), num_columns) for chunk, start in enumerate(xrange(0, num_vertices, STAR_CHUNK_SIZE))]
+    acceptance = numpy.concatenate(map_func(draw_edge_acceptance_chunk, tasks))
     
+    sources, targets = sample_edges(distance_data, index_data, acceptance)
     
-#load data from an sqlite version of an eve data dump (intended for use with http://pozniak.pl/wp/?page_id=530)
-def load_sqlite(filename):
-    con = sqlite3.connect(filename)
-    con.row_factory = sqlite3.Row
-    cursor = con.cursor()
+    return edges_to_csr(sources, targets, num_vertices)
+
+
+#decide which neighbors each of num_vertices vertices would accept an edge to, if it has that many neighbors
+#the neighbor in column i is accepted if a beta(i, 2.1) sample is less than 0.5
+def draw_edge_acceptance(random_state, num_vertices, num_columns):
+    return random_state.beta(numpy.arange(1, num_columns), 2.1, size=(num_vertices, num_columns - 1)) < 0.5
+
+def draw_edge_acceptance_chunk(task):
+    seed, chunk, count, num_columns = task
+    return draw_edge_acceptance(chunk_random_state(seed, EDGE_STREAM, chunk), count, num_columns)
+
+
+#returns the source and target of every edge that was accepted. each edge is only returned in one direction, and might be returned twice
+#acceptance comes from draw_edge_acceptance. missing neighbors have an infinite distance, and are never accepted
+def sample_edges(distance_data, index_data, acceptance):
+    num_vertices, num_columns = index_data.shape
     
-    #create a map from region id to faction id
-    faction_map = {}
-    for row in cursor.execute("SELECT * FROM mapregions"):
-        region_id = row['regionID']
-        faction_id = row['factionID']
-        
-        #if this region doesn't have a faction, set the faction id to -1
-        if(faction_id == None):
-            faction_map[region_id] = -1
-        else:
-            faction_map[region_id] = faction_id
+    accepted = acceptance & numpy.isfinite(distance_data[:,1:])
     
-    #load vertices
-    vertices = {}
-    for row in cursor.execute("SELECT * FROM mapsolarsystems"):
-        vertex = {}
-        vertex['faction'] = int(faction_map[row['regionID']])
-        vertex['region'] = int(row['regionID'])
-        vertex['constellation'] = int(row['constellationID'])
-        vertex['name'] = row['solarSystemName']
-        vertex['security'] = row['security']
-        
-        vertex['position'] = Vector3D(row['x'], row['y'], -row['z'])#we have to flip the z axis
-        
-        vertices[int(row['solarSystemID'])] = vertex
+    sources = numpy.repeat(index_data[:,:1], num_columns - 1, axis=1)[accepted]
+    targets = index_data[:,1:][accepted]
     
-    #load edges
-    edges = {v:set() for v in vertices.iterkeys()}
-    for row in cursor.execute("SELECT * FROM mapsolarsystemjumps"):
-        edges[row['fromSolarSystemID']].add(row['toSolarSystemID'])
+    return sources, targets
 
-    #the vertices dict currently includes the wormhole systems, and we don't want those. so remove any vertex that has no edges
-    vertices, edges = remove_disconnected_stars(vertices, edges)
+
+def edges_to_csr(sources, targets, num_vertices):
     
-    #we have to normalize the position, since it's huge right now
-    #shrink everything so every vertex is at most 2000 units away
-    max_distance = max(v['position'].length() for v in vertices.itervalues())
-    multiplier = 5000/max_distance
-    for v in vertices.itervalues():
-        v['position'] *= multiplier
-        
-    return vertices, edges
+    #add both directions of every edge, then sort them by source and remove the duplicates
+    edge_ids = numpy.unique(numpy.concatenate((sources * num_vertices + targets, targets * num_vertices + sources)))
+    rows, indices = numpy.divmod(edge_ids, num_vertices)
+    
+    indptr = numpy.zeros(num_vertices + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=num_vertices), out=indptr[1:])
+    
+    return indptr, indices
 
 
-def remove_disconnected_stars(position_dict, edge_dict):
+#convert a CSR adjacency into the dict of sets used by the rest of the galaxy generator
+def csr_to_edge_dict(indptr, indices):
+    bounds = indptr.tolist()
+    neighbors = indices.tolist()
+    
+    return {v:set(neighbors[bounds[v]:bounds[v + 1]]) for v in xrange(len(bounds) - 1)}
+    
+    
+#the other way around: convert an edge dict into a CSR adjacency, with the vertices in the order of node_keys
+#the neighbors of vertex i are indices[indptr[i]:indptr[i+1]]
+def edge_dict_to_csr(node_keys, edge_dict):
+    key_to_index = {k:i for i, k in enumerate(node_keys)}
+    
+    indptr = numpy.zeros(len(node_keys) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(edge_dict[k]) for k in node_keys], out=indptr[1:])
     
-    #create a mapping from keys to indexes and indexes back to keys
-    index_to_key = position_dict.keys()
-    key_to_index = {k:i for i,k in enumerate(index_to_key)}
+    indices = numpy.fromiter((key_to_index[n] for k in node_keys for n in edge_dict[k]), dtype=numpy.int64, count=indptr[-1])
     
-    #build an adjacency matrix using the scipy sparse matrix library.
-    #the scipy docs recommend using dok_matrix for incrementally building a matrix like this
-    mat_size = len(edge_dict)
-    mat = dok_matrix( (mat_size,mat_size), dtype=numpy.int8)
+    return indptr, indices
     
-    for v, neighbors in edge_dict.iteritems():
-        for n in neighbors:
-            mat[key_to_index[v],key_to_index[n]] = 1
-            
-    #compute the connected components
-    n, component_array = csgraph.connected_components(mat)
     
-    #group the vertices into their components
-    component_group = dict()
-    for index, group in enumerate(component_array):
-        if(group not in component_group):
-            component_group[group] = []
-        component_group[group].append(index_to_key[index])
+#load data from an sqlite version of an eve data dump (intended for use with http://pozniak.pl/wp/?page_id=530)
+#the parsed dump is cached in a file next to it, so loading the same dump again doesn't have to touch sqlite at all
+def load_sqlite(filename, use_cache=True):
+    cache_filename = filename + SQLITE_CACHE_EXTENSION
+    
+    arrays = None
+    if(use_cache):
+        arrays = load_sqlite_cache(cache_filename, filename)
         
+    if(arrays is None):
+        arrays = read_sqlite_arrays(filename)
         
-    #sort the components by size
-    sorted_components = sorted((len(component), component) for component in component_group.itervalues())
-    
-    #put the elements of every component but the last into the disconnection set. the last component is the largest.
-    disconnection_set = set()
-    for size,vertices in sorted_components[:-1]:
-        disconnection_set.update(vertices)
-            
-    #use the index map to convert old indexes to new indexes in the edge dict
-    new_position_dict = {}
-    new_edge_dict = {}
-    for v, neighbors in position_dict.iteritems():
+        if(use_cache):
+            save_sqlite_cache(cache_filename, filename, arrays)
+    
+    #convert the arrays to the dicts used by the rest of the galaxy generator
+    vertices = {}
+    for system_id, faction_id, region_id, constellation_id, name, security, position in izip(
+            arrays['system_ids'].tolist(), arrays['faction_ids'].tolist(), arrays['region_ids'].tolist(), arrays['constellation_ids'].tolist(),
+            arrays['names'].tolist(), arrays['security'].tolist(), arrays['positions'].tolist()):
         
-        if(v not in disconnection_set):
-            new_position_dict[v] = position_dict[v]
-            new_edge_dict[v] = edge_dict[v]
-            
-    return new_position_dict, new_edge_dict
+        vertices[system_id] = {
+            'faction': faction_id,
+            'region': region_id,
+            'constellation': constellation_id,
+            'name': name,
+            'security': security,
+            'position': Vector3D(*position),
+            }
+    
+    system_ids = arrays['system_ids'].tolist()
+    bounds = arrays['jump_indptr'].tolist()
+    jump_targets = arrays['jump_targets'].tolist()
+    edges = {system_ids[i]:set(jump_targets[bounds[i]:bounds[i + 1]]) for i in xrange(len(system_ids))}
     
+    return vertices, edges
+
+
+#read the columns we need from the dump into arrays, remove the disconnected systems and normalize the positions
+#the jumps from the system at index i go to the system ids jump_targets[jump_indptr[i]:jump_indptr[i+1]]
+def read_sqlite_arrays(filename):
+    con = sqlite3.connect(filename)
+    cursor = con.cursor()
     
+    #create a map from region id to faction id. if a region doesn't have a faction, set the faction id to -1
+    faction_map = {region_id:(-1 if faction_id is None else int(faction_id)) for region_id, faction_id in cursor.execute("SELECT regionID, factionID FROM mapregions")}
     
+    #load vertices
+    rows = cursor.execute("SELECT solarSystemID, regionID, constellationID, solarSystemName, security, x, y, z FROM mapsolarsystems").fetchall()
+    system_ids, region_ids, constellation_ids, names, security, x, y, z = zip(*rows)
+    
+    system_ids = numpy.array(system_ids, dtype=numpy.int64)
+    region_ids = numpy.array(region_ids, dtype=numpy.int64)
+    positions = numpy.column_stack((x, y, -numpy.array(z, dtype=numpy.float64)))#we have to flip the z axis
     
+    #load edges, and convert the system ids to indexes
+    jumps = numpy.array(cursor.execute("SELECT fromSolarSystemID, toSolarSystemID FROM mapsolarsystemjumps").fetchall(), dtype=numpy.int64).reshape(-1, 2)
+    con.close()
     
+    id_order = numpy.argsort(system_ids)
+    sources = id_order[numpy.searchsorted(system_ids, jumps[:,0], sorter=id_order)]
+    targets = id_order[numpy.searchsorted(system_ids, jumps[:,1], sorter=id_order)]
     
+    #jumps are listed in both directions in the dump, so unlike a generated galaxy they're kept exactly as they are
+    edge_ids = numpy.unique(sources * len(system_ids) + targets)
+    rows, indices = numpy.divmod(edge_ids, len(system_ids))
+    indptr = numpy.zeros(len(system_ids) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(rows, minlength=len(system_ids)), out=indptr[1:])
     
+    #the systems include the wormhole systems, and we don't want those. so only keep the largest connected group of systems
+    kept_ids, positions, indptr, indices = remove_disconnected_arrays(positions, indptr, indices)
+    
+    #we have to normalize the position, since it's huge right now
+    #shrink everything so every vertex is at most 5000 units away
+    max_distance = numpy.sqrt((positions**2).sum(axis=1)).max()
+    positions *= 5000/max_distance
+    
+    system_ids = system_ids[kept_ids]
+    region_ids = region_ids[kept_ids]
+    
+    return {
+        'system_ids': system_ids,
+        'faction_ids': numpy.array([faction_map[region_id] for region_id in region_ids.tolist()], dtype=numpy.int64),
+        'region_ids': region_ids,
+        'constellation_ids': numpy.array(constellation_ids, dtype=numpy.int64)[kept_ids],
+        'names': numpy.array(names, dtype=numpy.unicode_)[kept_ids],
+        'security': numpy.array(security, dtype=numpy.float64)[kept_ids],
+        'positions': positions,
+        'jump_indptr': indptr,
+        'jump_targets': system_ids[indices],
+        }
+
+
+#returns the cached arrays for the dump, or None if there's no cache or the dump has changed since the cache was written
+def load_sqlite_cache(cache_filename, filename):
+    if(not os.path.exists(cache_filename)):
+        return None
+    
+    with numpy.load(cache_filename) as cache:
+        arrays = dict(cache)
+    
+    source_stat = os.stat(filename)
+    if(arrays.pop('cache_key').tolist() != [SQLITE_CACHE_VERSION, source_stat.st_size, source_stat.st_mtime]):
+        return None
+    return arrays
+
+def save_sqlite_cache(cache_filename, filename, arrays):
+    source_stat = os.stat(filename)
+    cache_key = numpy.array([SQLITE_CACHE_VERSION, source_stat.st_size, source_stat.st_mtime], dtype=numpy.float64)
     
+    serialize.atomic_write(cache_filename, lambda datafile: numpy.savez(datafile, cache_key=cache_key, **arrays))
+
+
+#keep only the largest connected component of a CSR adjacency. the remaining vertices are renumbered from 0 in their original order
+#returns the original index of every remaining vertex, and their positions and adjacency
+def remove_disconnected_arrays(positions, indptr, indices):
+    keep = find_largest_component(indptr, indices)
+    kept_ids = numpy.flatnonzero(keep)
     
+    #map each old index to its new index. every neighbor of a kept vertex is in the same component, so it's kept too
+    new_ids = numpy.cumsum(keep) - 1
     
+    rows = numpy.repeat(numpy.arange(len(keep)), numpy.diff(indptr))
+    edge_mask = keep[rows]
     
+    new_indptr = numpy.zeros(len(kept_ids) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.diff(indptr)[keep], out=new_indptr[1:])
     
+    return kept_ids, positions[keep], new_indptr, new_ids[indices[edge_mask]]
+
+
+#find the connected components of a CSR adjacency. returns the component of every vertex, and the number of vertices in each component
+def find_components(indptr, indices):
+    num_vertices = len(indptr) - 1
+    mat = csr_matrix((numpy.ones(len(indices), dtype=numpy.int8), indices, indptr), shape=(num_vertices, num_vertices))
     
-    
\ No newline at end of file
+    n, component_array = csgraph.connected_components(mat, directed=False)
+    return component_array, numpy.bincount(component_array, minlength=n)
+
+
+#returns a boolean mask of the vertices in the largest connected component of a CSR adjacency
+def find_largest_component(indptr, indices):
+    component_array, component_sizes = find_components(indptr, indices)
+    return component_array == numpy.argmax(component_sizes)
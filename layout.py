@@ -10,102 +10,766 @@ Motivations for doing so might be to make the graph more visually appealing, for
 
 import datetime
 import math
+import multiprocessing
+import random
+import time
 from functools import partial
 from itertools import izip
 
 import serialize
+from utils.octree import Octree
 from utils.vector3d import Vector3D
 
-def forced_directed_layout(star_dict, edge_dict, iterations=1):
+#the default force constants. to try other values without editing them here, override them with set_constants,
+#or list them as "group.name" parameters in a sweep config, see sweep.py
+REPULSION_CONSTANTS = dict(
+    linear_constant=0.5,
+    quad_constant=0,
+    cubic_constant=9000,
+    )
+ATTRACTION_CONSTANTS = dict(
+    log_constant=1,
+    linear_constant=0.001, 
+    quad_constant=0.0001,
+    cubic_constant=0.0000001,
+    different_region_multiplier=0.05
+    )
+GLOBAL_CONSTANTS = dict(
+    center_constant=.0005,
+    plane_constant=1
+    )
+
+#the constants above, by the name used to override them, eg 'repulsion.cubic_constant'
+CONSTANT_GROUPS = {
+    'repulsion': REPULSION_CONSTANTS,
+    'attraction': ATTRACTION_CONSTANTS,
+    'global': GLOBAL_CONSTANTS,
+    }
+
+INITIAL_TIMESTEP = 0.9
+SWING_TOLERANCE = .2
+
+#the groups of stars computed by regions.compute_regions, largest first
+GROUP_KEYS = ['region', 'constellation']
+
+#how hard overlapping groups push each other apart in the coarse layout
+CONTACT_CONSTANT = 0.1
+
+#overrides is a dict mapping names like 'repulsion.cubic_constant' to new values. this changes the constants for every layout run by this process afterwards
+def set_constants(overrides):
+    for name, value in overrides.iteritems():
+        group, _, key = name.partition('.')
+        
+        constants = CONSTANT_GROUPS.get(group)
+        if(constants is None or key not in constants):
+            raise ValueError("Unknown layout constant: %s"%name)
+        constants[key] = value
+
+
+#repulsion is either 'exact', which compares every pair of vertices, or 'barnes-hut', which approximates it with an octree
+#theta is the barnes-hut opening angle: larger values are faster but less accurate
+#workers is the number of processes to split the force computation between
+#state is a checkpoint created by create_state to resume from, and checkpoint is a CheckpointSchedule used to save new ones
+#if convergence is a ConvergenceCriteria, the layout stops as soon as it's met instead of running every iteration
+#if trace is a telemetry.LayoutTrace, a record of timings and statistics is written to it for every iteration
+#if max_step is given, no vertex moves further than that in one iteration. a vertex that gets very close to another one can otherwise be flung across the galaxy by the repulsion
+#returns a description of why the layout stopped
+def forced_directed_layout(star_dict, edge_dict, iterations=1, repulsion='exact', theta=0.5, workers=1, state=None, checkpoint=None, convergence=None, trace=None, max_step=None):
     
     node_keys = star_dict.keys()
     
-    #TODO: dont hardcode these values. get them from python's settings module or something
-    #that way we can git ingore the settings file and changing the numbers wont cause deltas
-    #build functions to pass to map()
-    repel_func = partial(compute_repel_force,
-        linear_constant=0.5,
-        quad_constant=0,
-        cubic_constant=9000,
-        )
-    attraction_func = partial(compute_attraction_force,
-        log_constant=1,
-        linear_constant=0.001, 
-        quad_constant=0.0001,
-        cubic_constant=0.0000001,
-        different_region_multiplier=0.05
-        )
+    #create the functions that will be called by map
+    attraction_total_func, repulsion_total_func = build_force_funcs(star_dict, edge_dict, theta)
+    
+    #if we're using more than one process, start them up now so they can be reused for every iteration
+    if(workers > 1):
+        force_pool = ForcePool(workers, node_keys, star_dict, edge_dict, repulsion, theta)
+    else:
+        force_pool = None
+    
+    #create an array of the forces that were computed on the previous frame
+    previous_forces = {}
+    
+    timestep = INITIAL_TIMESTEP
+    swing_tolerance = SWING_TOLERANCE
+    printstep = int((100.0 / (len(star_dict)**2)) * 1000.0) or 1
+    
+    #the total energy of the previous frame, ie the sum of the squared force on every vertex
+    previous_energy = None
+    
+    #if we're resuming, pick up the positions, swing data and timestep exactly where the checkpoint left them
+    first_iteration = 0
+    if(state is not None):
+        restore_positions(star_dict, state)
+        previous_forces = dict(state['previous_forces'])
+        previous_energy = state['energy']
+        timestep = state['timestep']
+        first_iteration = state['iteration']
+    
+    stop_reason = "completed %d iterations"%iterations
+    
+    if(printstep < iterations):
+        print "0%"
+    
+    start_time = datetime.datetime.now()
+    
+    #make sure the worker processes are shut down even if the layout is interrupted
+    try:
+        for i in xrange(first_iteration, iterations):
+            #compute the forces for this frame
+            if(force_pool is not None):
+                current_forces, attraction_seconds, repulsion_seconds = force_pool.compute_forces(star_dict)
+            else:
+                octree_start = time.time()
+                octree = build_octree(star_dict, repulsion)
+                octree_seconds = time.time() - octree_start
+                
+                current_forces, attraction_seconds, repulsion_seconds = compute_forces(node_keys, attraction_total_func, repulsion_total_func, octree)
+                repulsion_seconds += octree_seconds
+            
+            integration_start = time.time()
+            
+            #use the current and previous force data to update the global speed
+            timestep = update_timestep(timestep, previous_forces, current_forces, swing_tolerance)
         
-    global_func = partial(compute_global_force,
-        center_constant=.0005,
-        plane_constant=1
-        )
+            #apply the forces
+            max_displacement, mean_displacement, mean_swing = apply_forces(star_dict, current_forces, previous_forces, timestep, max_step)
+            
+            integration_seconds = time.time() - integration_start
+            
+            energy = sum(force.length_sq() for force in current_forces.itervalues())
+            
+            if(trace is not None):
+                trace.record(
+                    iteration=i + 1,
+                    attraction_seconds=attraction_seconds,
+                    repulsion_seconds=repulsion_seconds,
+                    integration_seconds=integration_seconds,
+                    timestep=timestep,
+                    mean_swing=mean_swing,
+                    total_force=sum(force.length() for force in current_forces.itervalues()),
+                    energy=energy,
+                    max_displacement=max_displacement,
+                    mean_displacement=mean_displacement,
+                    )
+            
+            previous_forces = current_forces
+            
+            if(i % printstep == 0):
+                print_progress(i, iterations, start_time, timestep, first_iteration)
+            
+            if(checkpoint is not None and checkpoint.is_due(i + 1)):
+                checkpoint.save(create_state(star_dict, previous_forces, energy, timestep, i + 1, iterations))
+            
+            if(convergence is not None):
+                converged = convergence.check(energy, previous_energy, max_displacement, mean_displacement)
+                if(converged is not None):
+                    stop_reason = "converged after %d iterations: %s"%(i + 1, converged)
+                    break
+            previous_energy = energy
+    finally:
+        if(force_pool is not None):
+            force_pool.close()
+    
+    return stop_reason
+            
+
+#a checkpoint holds everything needed to continue a layout exactly where it stopped
+#iteration is the number of iterations that have been completed, out of a total of iterations
+def create_state(star_dict, previous_forces, energy, timestep, iteration, iterations):
+    return {
+        'positions': {k:v['position'] for k, v in star_dict.iteritems()},
+        'previous_forces': previous_forces,
+        'energy': energy,
+        'timestep': timestep,
+        'iteration': iteration,
+        'iterations': iterations,
+        }
+
+def restore_positions(star_dict, state):
+    for k, position in state['positions'].iteritems():
+        star_dict[k]['position'] = position
+
+
+#decides when to save a checkpoint: every N iterations, every T seconds, or both. 0 disables either one
+class CheckpointSchedule(object):
+    def __init__(self, save_func, iterations=0, seconds=0):
+        self.save_func = save_func
+        self.iterations = iterations
+        self.seconds = seconds
+        self.last_save = datetime.datetime.now()
+        
+    def is_due(self, completed_iterations):
+        if(self.iterations > 0 and completed_iterations % self.iterations == 0):
+            return True
+        if(self.seconds > 0 and (datetime.datetime.now() - self.last_save).total_seconds() >= self.seconds):
+            return True
+        return False
     
+    def save(self, state):
+        self.save_func(state)
+        self.last_save = datetime.datetime.now()
+
+
+#decides when a layout has stopped moving. a layout has converged when every threshold that isn't None has been met:
+#the largest distance any vertex moved, the average distance every vertex moved, and the relative change in total energy since the previous frame
+class ConvergenceCriteria(object):
+    def __init__(self, max_displacement=None, mean_displacement=None, energy_change=None):
+        self.max_displacement = max_displacement
+        self.mean_displacement = mean_displacement
+        self.energy_change = energy_change
+    
+    #returns a description of the thresholds that were met if the layout has converged, or None if it hasn't
+    def check(self, energy, previous_energy, max_displacement, mean_displacement):
+        reasons = []
+        
+        if(self.max_displacement is not None):
+            if(max_displacement >= self.max_displacement):
+                return None
+            reasons.append("max displacement %.4g < %g"%(max_displacement, self.max_displacement))
+            
+        if(self.mean_displacement is not None):
+            if(mean_displacement >= self.mean_displacement):
+                return None
+            reasons.append("mean displacement %.4g < %g"%(mean_displacement, self.mean_displacement))
+            
+        if(self.energy_change is not None):
+            if(previous_energy is None or previous_energy == 0):
+                return None
+            
+            energy_change = abs(energy - previous_energy) / previous_energy
+            if(energy_change >= self.energy_change):
+                return None
+            reasons.append("energy change %.4g < %g"%(energy_change, self.energy_change))
+            
+        if(len(reasons) > 0):
+            return ", ".join(reasons)
+        else:
+            return None
+
+
+#returns a function computing the global and attraction forces on a vertex, and a function computing the repulsion on a vertex
+def build_force_funcs(vertex_dict, edge_dict, theta):
     
+    #build functions to pass to map()
+    repel_func = partial(compute_repel_force, **REPULSION_CONSTANTS)
+    attraction_func = partial(compute_attraction_force, **ATTRACTION_CONSTANTS)
+    global_func = partial(compute_global_force, **GLOBAL_CONSTANTS)
     
-    #create the function that will be called by map
-    total_force_func = partial(compute_vertex_force,
-        vertex_dict=star_dict,
+    attraction_total_func = partial(compute_vertex_attraction,
+        vertex_dict=vertex_dict,
         edge_dict=edge_dict,
         attraction_func=attraction_func,
-        repulsion_func=repel_func,
         global_func=global_func
         )
+    repulsion_total_func = partial(compute_vertex_repulsion,
+        vertex_dict=vertex_dict,
+        repulsion_func=repel_func,
+        theta=theta
+        )
+    return attraction_total_func, repulsion_total_func
+
+
+#compute the total force on each of the given vertices. the attraction and repulsion are computed in separate passes so they can be timed separately
+#returns the forces, and the number of seconds spent on attraction and on repulsion
+def compute_forces(keys, attraction_total_func, repulsion_total_func, octree):
+    attraction_start = time.time()
+    attraction_forces = {k:attraction_total_func(k) for k in keys}
     
-    #create an array of the forces that were computed on the previous frame
-    previous_forces = {}
+    repulsion_start = time.time()
+    current_forces = {k:attraction_forces[k] + repulsion_total_func(k, octree=octree) for k in keys}
     
-    timestep = 0.9
-    swing_tolerance = .2
-    printstep = int((100.0 / (len(star_dict)**2)) * 1000.0) or 1
+    return current_forces, repulsion_start - attraction_start, time.time() - repulsion_start
+
+
+#if we're approximating repulsion, build an octree of this frame's positions. every vertex has a mass of 1
+def build_octree(vertex_dict, repulsion):
+    if(repulsion == 'barnes-hut'):
+        return Octree.from_points((vertex['position'], 1) for vertex in vertex_dict.itervalues())
+    else:
+        return None
+
+
+#the force on each vertex only depends on the positions from the previous frame, so the vertices can be split up between processes
+#positions are written to shared memory once per frame instead of being pickled and sent to every worker
+class ForcePool(object):
+    def __init__(self, workers, node_keys, star_dict, edge_dict, repulsion, theta):
+        self.node_keys = node_keys
+        self.iteration = 0
+        
+        #3 doubles per vertex, in the same order as node_keys
+        self.shared_positions = multiprocessing.RawArray('d', 3 * len(node_keys))
+        
+        #everything except the positions stays the same for the whole layout, so it's only sent to the workers once
+        regions = [star_dict[k]['region'] for k in node_keys]
+        self.pool = multiprocessing.Pool(workers,
+            initializer=init_force_worker,
+            initargs=(self.shared_positions, node_keys, regions, edge_dict, repulsion, theta)
+            )
+        
+        #split the vertices into a few chunks per worker, so that a slow chunk doesn't hold everything up
+        num_chunks = min(workers * 4, len(node_keys))
+        bounds = [len(node_keys) * c // num_chunks for c in xrange(num_chunks + 1)]
+        self.chunks = zip(bounds[:-1], bounds[1:])
+        
+    #returns the forces, and the wall time spent on attraction and on repulsion, like compute_forces
+    def compute_forces(self, star_dict):
+        start_time = time.time()
+        
+        self.shared_positions[:] = [c for k in self.node_keys for c in star_dict[k]['position']]
+        self.iteration += 1
+        
+        results = self.pool.map(compute_force_chunk, [(self.iteration, start, end) for start, end in self.chunks], chunksize=1)
+        
+        current_forces = {}
+        attraction_cpu_seconds = 0
+        repulsion_cpu_seconds = 0
+        for (start, end), (forces, chunk_attraction_seconds, chunk_repulsion_seconds) in izip(self.chunks, results):
+            current_forces.update(izip(self.node_keys[start:end], forces))
+            attraction_cpu_seconds += chunk_attraction_seconds
+            repulsion_cpu_seconds += chunk_repulsion_seconds
+        
+        #the workers run at the same time, so adding up their timings would count the same second several times
+        #instead, split the wall time of the whole step between attraction and repulsion in proportion to the time the workers spent on each
+        wall_seconds = time.time() - start_time
+        cpu_seconds = attraction_cpu_seconds + repulsion_cpu_seconds
+        if(cpu_seconds > 0):
+            attraction_seconds = wall_seconds * attraction_cpu_seconds / cpu_seconds
+        else:
+            attraction_seconds = 0
+        return current_forces, attraction_seconds, wall_seconds - attraction_seconds
     
-    if(printstep < iterations):
-        print "0%"
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+#the state of a force pool worker process, filled in by init_force_worker
+worker_state = {}
+
+def init_force_worker(shared_positions, node_keys, regions, edge_dict, repulsion, theta):
+    vertex_dict = {k:{'region':region} for k, region in izip(node_keys, regions)}
     
-    start_time = datetime.datetime.now()
+    worker_state.update(
+        shared_positions=shared_positions,
+        node_keys=node_keys,
+        vertex_dict=vertex_dict,
+        repulsion=repulsion,
+        force_funcs=build_force_funcs(vertex_dict, edge_dict, theta),
+        iteration=None,
+        octree=None,
+        )
+    
+def compute_force_chunk(task):
+    iteration, start, end = task
+    state = worker_state
+    vertex_dict = state['vertex_dict']
+    
+    #if this is the first chunk this worker has seen for this frame, copy the new positions out of shared memory
+    octree_seconds = 0
+    if(state['iteration'] != iteration):
+        positions = state['shared_positions'][:]
+        for i, k in enumerate(state['node_keys']):
+            vertex_dict[k]['position'] = Vector3D(positions[3*i], positions[3*i + 1], positions[3*i + 2])
+        
+        octree_start = time.time()
+        state['octree'] = build_octree(vertex_dict, state['repulsion'])
+        octree_seconds = time.time() - octree_start
+        
+        state['iteration'] = iteration
+    
+    attraction_total_func, repulsion_total_func = state['force_funcs']
+    keys = state['node_keys'][start:end]
+    
+    current_forces, attraction_seconds, repulsion_seconds = compute_forces(keys, attraction_total_func, repulsion_total_func, state['octree'])
+    return [current_forces[k] for k in keys], attraction_seconds, repulsion_seconds + octree_seconds
+            
+
+#after a local edit to the graph, relax only the stars near the edit instead of laying out the whole galaxy again
+#every star within hops jumps of a changed star is free to move, and every other star stays where it is
+#changed stars that don't have a position yet are placed next to their neighbors first
+#the repulsion from the frozen stars is approximated with an octree, which only has to be built once since they never move
+#returns a description of why the layout stopped
+def relax_layout(star_dict, edge_dict, changed, hops=3, iterations=100, theta=0.5, convergence=None):
+    
+    unknown = [k for k in changed if k not in star_dict]
+    if(len(unknown) > 0):
+        raise ValueError("Unknown stars: %s"%", ".join(str(k) for k in unknown))
+    
+    place_new_vertices(star_dict, edge_dict, changed)
+    
+    active_keys = find_neighborhood(edge_dict, changed, hops)
+    active_dict = {k:star_dict[k] for k in active_keys}
+    if(len(active_dict) == 0):
+        return "nothing to relax"
+    
+    frozen_points = [(vertex['position'], 1) for k, vertex in star_dict.iteritems() if k not in active_dict]
+    if(len(frozen_points) > 0):
+        frozen_octree = Octree.from_points(frozen_points)
+    else:
+        frozen_octree = None
+    
+    print "Relaxing %d of %d stars..."%(len(active_dict), len(star_dict))
+    
+    #attraction is computed against the full star dict, so that the edges to frozen stars still pull on the active ones
+    #the active stars repel each other exactly, since there are only a few of them
+    repel_func = partial(compute_repel_force, **REPULSION_CONSTANTS)
+    attraction_total_func, _ = build_force_funcs(star_dict, edge_dict, theta)
+    repulsion_total_func = partial(compute_vertex_repulsion, vertex_dict=active_dict, repulsion_func=repel_func)
+    
+    previous_forces = {}
+    previous_energy = None
+    timestep = INITIAL_TIMESTEP
+    
+    stop_reason = "completed %d iterations"%iterations
     for i in xrange(iterations):
-        #compute the forces for this frame
-        current_forces = {k:total_force_func(k) for k in node_keys}
+        current_forces, attraction_seconds, repulsion_seconds = compute_forces(active_keys, attraction_total_func, repulsion_total_func, None)
+        if(frozen_octree is not None):
+            for k, force in current_forces.iteritems():
+                current_forces[k] = force + frozen_octree.compute_repulsion(active_dict[k]['position'], repel_func, theta)
         
-        #use the current and previous force data to update the global speed
-        timestep = update_timestep(timestep, previous_forces, current_forces, swing_tolerance)
+        timestep = update_timestep(timestep, previous_forces, current_forces, SWING_TOLERANCE)
+        max_displacement, mean_displacement, mean_swing = apply_forces(active_dict, current_forces, previous_forces, timestep)
+        previous_forces = current_forces
+        
+        energy = sum(force.length_sq() for force in current_forces.itervalues())
+        if(convergence is not None):
+            converged = convergence.check(energy, previous_energy, max_displacement, mean_displacement)
+            if(converged is not None):
+                stop_reason = "converged after %d iterations: %s"%(i + 1, converged)
+                break
+        previous_energy = energy
+        
+    return stop_reason
+
+
+#returns every vertex within hops edges of any of the start vertices, including the start vertices themselves
+def find_neighborhood(edge_dict, start, hops):
+    visited = set(start)
+    frontier = list(visited)
+    
+    for i in xrange(hops):
+        next_frontier = []
+        for v in frontier:
+            for n in edge_dict.get(v, ()):
+                if(n not in visited):
+                    visited.add(n)
+                    next_frontier.append(n)
+        frontier = next_frontier
+        
+    return list(visited)
+
+
+#give every one of the given vertices that has no position yet a position near the average of its neighbors
+#a vertex without a region or constellation joins the ones most of its neighbors are in, since new stars can't be given one until they have a position
+#a new vertex might only be connected to other new vertices, so keep going until no more can be placed
+def place_new_vertices(vertex_dict, edge_dict, keys):
+    unplaced = {k for k in keys if vertex_dict[k].get('position') is None or any(group_key not in vertex_dict[k] for group_key in GROUP_KEYS)}
     
-        #apply the forces
-        for v, vertex in star_dict.iteritems():
+    while(len(unplaced) > 0):
+        placed = {}
+        for k in unplaced:
+            neighbors = [vertex_dict[n] for n in edge_dict.get(k, ()) if n not in unplaced]
             
-            current_force = current_forces[v]
+            if(len(neighbors) > 0):
+                placed[k] = neighbors
+        
+        if(len(placed) == 0):
+            raise ValueError("%d new stars are not connected to any star with a position"%len(unplaced))
+        
+        for k, neighbors in placed.iteritems():
+            vertex = vertex_dict[k]
             
-            #we need to compute the "local speed" - in addition to updating the global timestep based on swing, we also do the same for each vertex
-            if(v in previous_forces):
-                prev_force = previous_forces[v]
-                
-                #take the dot product of the current force with the previous force, both normalized
-                #if the dot product is negative, there must be some swing going on
-                #timestep * sqrt((dot + 1)*0.5) will result in a local timestep close to 0 if the dot product is close to -1
-                #and will result in a local timestep close to the global timestep if the dot product is close to 1
-                swing_dot = Vector3D.dot(prev_force.normalized(),current_force.normalized())
+            if(vertex.get('position') is None):
+                average = sum((n['position'] for n in neighbors), Vector3D(0,0,0)) * (1.0 / len(neighbors))
                 
-                local_timestep = timestep * math.sqrt((swing_dot + 1) * 0.5)
+                #two vertices at exactly the same position don't repel each other, so offset each one slightly
+                vertex['position'] = average + Vector3D(random.uniform(-1,1), random.uniform(-1,1), random.uniform(-1,1))
+            
+            for group_key in GROUP_KEYS:
+                if(group_key not in vertex):
+                    counts = {}
+                    for n in neighbors:
+                        counts[n[group_key]] = counts.get(n[group_key], 0) + 1
+                    vertex[group_key] = max(counts.iterkeys(), key=counts.get)
+        unplaced.difference_update(placed)
+            
+
+#lay out the region graph, then the constellation graph, moving every star along with its constellation
+#this gets the stars close to their final positions so that only a few expensive full-resolution iterations are needed afterwards
+def coarse_layout(star_dict, edge_dict, iterations=100, theta=0.5):
+    
+    #the distance between two connected stars where attraction and repulsion cancel out. groups are sized to fit their stars at this spacing
+    spacing = compute_equilibrium_distance(
+        partial(compute_attraction_force, **ATTRACTION_CONSTANTS),
+        partial(compute_repel_force, **REPULSION_CONSTANTS)
+        )
+    
+    #the area each region ended up covering, so that its constellations can be kept inside it
+    containers = None
+    
+    for group_key in GROUP_KEYS:
+        print "Laying out %ss..."%group_key
+        
+        coarse_dict, weight_map = build_coarse_graph(star_dict, edge_dict, group_key)
+        
+        #the layout packs stars much more tightly than the generator does, so shrink each group down to the size it will end up at
+        for vertex in coarse_dict.itervalues():
+            vertex['radius'] = spacing * math.sqrt(vertex['mass'] / math.pi)
+            
+            #the spread is the rms distance from the center, which is radius/sqrt(2) for an evenly filled disk
+            if(vertex['spread'] > 0):
+                vertex['scale'] = min(1.0, vertex['radius'] / (math.sqrt(2) * vertex['spread']))
             else:
-                local_timestep = timestep
+                vertex['scale'] = 1.0
                 
-            vertex['position'] += current_force * local_timestep
+        for star in star_dict.itervalues():
+            group = coarse_dict[star[group_key]]
+            star['position'] = group['position'] + (star['position'] - group['position']) * group['scale']
+        
+        original_positions = {g:vertex['position'] for g, vertex in coarse_dict.iteritems()}
+        layout_coarse_graph(coarse_dict, weight_map, iterations, theta, containers)
+        
+        #move each star by the same amount its group moved
+        for star in star_dict.itervalues():
+            group = star[group_key]
+            star['position'] += coarse_dict[group]['position'] - original_positions[group]
+        
+        if(group_key == 'region'):
+            containers = {g:(vertex['position'], vertex['radius']) for g, vertex in coarse_dict.iteritems()}
+            
+
+#find the distance where the attraction between two stars in the same region exactly cancels out their repulsion, using bisection
+def compute_equilibrium_distance(attraction_func, repulsion_func, low=1.0, high=1000.0):
+    def net_force(distance):
+        displacement = Vector3D(distance, 0, 0)
+        return (attraction_func(displacement, True) + repulsion_func(displacement))[0]
+    
+    for i in xrange(50):
+        middle = (low + high) * 0.5
+        
+        #repulsion wins at short distances, so the net force is negative until we pass the equilibrium
+        if(net_force(middle) < 0):
+            low = middle
+        else:
+            high = middle
+    return (low + high) * 0.5
+
+
+#collapse every group of stars into a single vertex at the group's center, with a mass equal to the number of stars in it
+#the weight of an edge between two groups is the number of star edges between them
+def build_coarse_graph(star_dict, edge_dict, group_key):
+    
+    coarse_dict = {}
+    for star in star_dict.itervalues():
+        group = star[group_key]
+        
+        if(group not in coarse_dict):
+            coarse_dict[group] = {'position':Vector3D(0,0,0), 'mass':0, 'region':star['region']}
+        
+        coarse_dict[group]['position'] += star['position']
+        coarse_dict[group]['mass'] += 1
+        
+    for vertex in coarse_dict.itervalues():
+        vertex['position'] *= 1.0 / vertex['mass']
+        vertex['spread'] = 0
+    
+    #compute the rms distance of each group's stars from its center
+    for star in star_dict.itervalues():
+        vertex = coarse_dict[star[group_key]]
+        vertex['spread'] += (star['position'] - vertex['position']).length_sq()
+    
+    for vertex in coarse_dict.itervalues():
+        vertex['spread'] = math.sqrt(vertex['spread'] / vertex['mass'])
+    
+    weight_map = {group:{} for group in coarse_dict.iterkeys()}
+    for v, neighbors in edge_dict.iteritems():
+        vg = star_dict[v][group_key]
+        
+        for n in neighbors:
+            ng = star_dict[n][group_key]
+            
+            if(vg != ng):
+                weight_map[vg][ng] = weight_map[vg].get(ng, 0) + 1
+                
+    return coarse_dict, weight_map
+
+
+#if containers is given, it maps each region to a center and a radius, and every group is kept inside the region it belongs to
+def layout_coarse_graph(coarse_dict, weight_map, iterations, theta, containers=None):
+    
+    #build functions to pass to map()
+    repel_func = partial(compute_repel_force, **REPULSION_CONSTANTS)
+    attraction_func = partial(compute_attraction_force, **ATTRACTION_CONSTANTS)
+    global_func = partial(compute_global_force, **GLOBAL_CONSTANTS)
+    
+    total_force_func = partial(compute_coarse_vertex_force,
+        vertex_dict=coarse_dict,
+        weight_map=weight_map,
+        attraction_func=attraction_func,
+        repulsion_func=repel_func,
+        global_func=global_func,
+        theta=theta
+        )
+    
+    previous_forces = {}
+    timestep = INITIAL_TIMESTEP
+    
+    for i in xrange(iterations):
+        #the octree holds each group's mass, so the repulsion from a group is as strong as the repulsion from all of its stars
+        octree = Octree.from_points((vertex['position'], vertex['mass']) for vertex in coarse_dict.itervalues())
+        contacts = find_contacts(coarse_dict)
+        
+        current_forces = {g:total_force_func(g, octree=octree, contacts=contacts[g]) for g in coarse_dict.iterkeys()}
+        
+        timestep = update_timestep(timestep, previous_forces, current_forces, SWING_TOLERANCE)
+        apply_forces(coarse_dict, current_forces, previous_forces, timestep)
         previous_forces = current_forces
         
-        if(i % printstep == 0):
-            current_time = datetime.datetime.now()
-            elapsed = current_time - start_time
+        if(containers is not None):
+            keep_inside_containers(coarse_dict, containers)
+
+
+#move any group whose disk pokes out of its region back onto the region's edge. a group bigger than its region is moved to the region's center
+def keep_inside_containers(coarse_dict, containers):
+    for vertex in coarse_dict.itervalues():
+        center, radius = containers[vertex['region']]
+        
+        limit = max(radius - vertex['radius'], 0)
+        offset = vertex['position'] - center
+        distance = offset.length()
+        
+        if(distance > limit):
+            vertex['position'] = center + offset * (limit / distance)
+
+
+#find every pair of groups that overlap, by sorting the groups into a grid of cells big enough that overlapping groups are always in adjacent cells
+def find_contacts(coarse_dict):
+    cell_size = 2 * max(vertex['radius'] for vertex in coarse_dict.itervalues())
+    
+    grid = {}
+    cells = {}
+    for g, vertex in coarse_dict.iteritems():
+        cell = tuple(int(math.floor(c / cell_size)) for c in vertex['position'])
+        cells[g] = cell
+        grid.setdefault(cell, []).append(g)
+        
+    contacts = {}
+    for g, vertex in coarse_dict.iteritems():
+        x, y, z = cells[g]
+        contacts[g] = []
+        
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for other in grid.get((x + dx, y + dy, z + dz), ()):
+                        other_vertex = coarse_dict[other]
+                        contact_distance = vertex['radius'] + other_vertex['radius']
+                        
+                        if(other != g and (other_vertex['position'] - vertex['position']).length_sq() < contact_distance * contact_distance):
+                            contacts[g].append(other)
+    return contacts
+
+
+#the force on a group is the average force on each of its stars, ignoring the forces between stars in the same group
+#since each group is collapsed to a point, overlapping groups also push each other apart to stand in for the repulsion between their stars
+def compute_coarse_vertex_force(g, vertex_dict, weight_map, attraction_func, repulsion_func, global_func, octree, contacts, theta):
+    
+    current_position = vertex_dict[g]['position']
+    current_region = vertex_dict[g]['region']
+    current_radius = vertex_dict[g]['radius']
+    
+    global_force = global_func(current_position)
+    attraction_force = Vector3D(0,0,0)
+    contact_force = Vector3D(0,0,0)
+    
+    #compute attraction to this group's neighbors, spread out over every star in the group
+    for n, weight in weight_map[g].iteritems():
+        displacement = vertex_dict[n]['position'] - current_position
+        same_region = (current_region == vertex_dict[n]['region'])
+        
+        attraction_force += attraction_func(displacement, same_region) * weight
+    attraction_force *= 1.0 / vertex_dict[g]['mass']
+    
+    repulsion_force = octree.compute_repulsion(current_position, repulsion_func, theta)
+    
+    #push apart from every group this one overlaps with, proportional to the overlap
+    for n in contacts:
+        displacement = vertex_dict[n]['position'] - current_position
+        distance = displacement.length()
+        
+        if(distance > 0):
+            overlap = current_radius + vertex_dict[n]['radius'] - distance
+            contact_force += displacement * (-CONTACT_CONSTANT * overlap / distance)
+    
+    return global_force + attraction_force + repulsion_force + contact_force
+
+
+#if max_step is given, any longer step is scaled down to that length
+#returns the largest and the average distance that any vertex moved, and the average swing dot product (or None if there were no previous forces)
+def apply_forces(vertex_dict, current_forces, previous_forces, timestep, max_step=None):
+    max_displacement = 0
+    total_displacement = 0
+    total_swing = 0
+    
+    for v, vertex in vertex_dict.iteritems():
+        
+        current_force = current_forces[v]
+        
+        #we need to compute the "local speed" - in addition to updating the global timestep based on swing, we also do the same for each vertex
+        if(v in previous_forces):
+            prev_force = previous_forces[v]
             
-            pct = float(i+1) / iterations
-            seconds_per_percent = elapsed.total_seconds() / pct
+            #take the dot product of the current force with the previous force, both normalized
+            #if the dot product is negative, there must be some swing going on
+            #timestep * sqrt((dot + 1)*0.5) will result in a local timestep close to 0 if the dot product is close to -1
+            #and will result in a local timestep close to the global timestep if the dot product is close to 1
+            swing_dot = Vector3D.dot(prev_force.normalized(),current_force.normalized())
+            total_swing += swing_dot
             
-            remaining_time = datetime.timedelta(seconds=(1 - pct) * seconds_per_percent)
-            eta = current_time + remaining_time
+            #rounding error can push the dot product slightly below -1
+            local_timestep = timestep * math.sqrt(max(swing_dot + 1, 0) * 0.5)
+        else:
+            local_timestep = timestep
             
-            print "%.1f%%, timestep=%.4f, remaining time=%s, eta=%s"%(round(pct*100,1), timestep, str(remaining_time), str(eta))
+        step = current_force * local_timestep
+        
+        step_length = step.length()
+        if(max_step is not None and step_length > max_step):
+            step *= max_step / step_length
+            step_length = max_step
             
+        vertex['position'] += step
+        
+        total_displacement += step_length
+        if(step_length > max_displacement):
+            max_displacement = step_length
+            
+    if(len(previous_forces) > 0):
+        mean_swing = total_swing / len(vertex_dict)
+    else:
+        mean_swing = None
+    
+    return max_displacement, total_displacement / len(vertex_dict), mean_swing
+
 
-def compute_vertex_force(v, vertex_dict, edge_dict, attraction_func, repulsion_func, global_func):
+def print_progress(i, iterations, start_time, timestep, first_iteration=0):
+    current_time = datetime.datetime.now()
+    elapsed = current_time - start_time
+    
+    pct = float(i+1) / iterations
+    
+    #if we resumed from a checkpoint, only the iterations since then count towards the time estimate
+    run_pct = float(i+1 - first_iteration) / (iterations - first_iteration)
+    seconds_per_percent = elapsed.total_seconds() / run_pct
+    
+    remaining_time = datetime.timedelta(seconds=(1 - run_pct) * seconds_per_percent)
+    eta = current_time + remaining_time
+    
+    print "%.1f%%, timestep=%.4f, remaining time=%s, eta=%s"%(round(pct*100,1), timestep, str(remaining_time), str(eta))
+    
+
+def compute_vertex_attraction(v, vertex_dict, edge_dict, attraction_func, global_func):
 
     current_position = vertex_dict[v]['position']
     current_region = vertex_dict[v]['region']
@@ -114,7 +778,6 @@ def compute_vertex_force(v, vertex_dict, edge_dict, attraction_func, repulsion_f
     
     global_force = global_func(current_position)
     attraction_force = Vector3D(0,0,0)
-    repulsion_force = Vector3D(0,0,0)
 
     #compute attraction to this vertex's neighbors
     for n in edge_dict[v]:
@@ -126,14 +789,25 @@ def compute_vertex_force(v, vertex_dict, edge_dict, attraction_func, repulsion_f
             
         attraction_force += attraction_func(displacement, same_region)
         
+    return global_force + attraction_force
+
+
+def compute_vertex_repulsion(v, vertex_dict, repulsion_func, octree=None, theta=0.5):
+    
+    current_position = vertex_dict[v]['position']
+    repulsion_force = Vector3D(0,0,0)
     
-    #compute the repulsion from every other vertex
-    for other_v, vertex in vertex_dict.iteritems():
-        if(v != other_v):
-            displacement = vertex_dict[n]['position'] - current_position
-            repulsion_force += repulsion_func(displacement)
+    if(octree is None):
+        #compute the repulsion from every other vertex
+        for other_v, vertex in vertex_dict.iteritems():
+            if(v != other_v):
+                displacement = vertex['position'] - current_position
+                repulsion_force += repulsion_func(displacement)
+    else:
+        #approximate the repulsion from every other vertex using the octree
+        repulsion_force = octree.compute_repulsion(current_position, repulsion_func, theta)
             
-    return global_force + attraction_force + repulsion_force
+    return repulsion_force
 
 
 def compute_global_force(position, center_constant, plane_constant):
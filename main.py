@@ -5,6 +5,7 @@
 import argparse
 import datetime
 import json
+import os
 
 
 import serialize
@@ -12,7 +13,10 @@ import serialize
 def main(options):
     import generator, printer, regions, centrality
     
-    print "Generating galaxy..."
+    #pick a seed if we weren't given one, so that this galaxy can be generated again
+    seed = options.seed if options.seed is not None else generator.random_seed()
+    
+    print "Generating galaxy with seed %d..."%seed
     star_array, edge_data = generator.generate_galaxy(
         num_stars=5000, 
         galaxy_radius=5000, 
@@ -21,30 +25,155 @@ def main(options):
         spiral_tightness=.5, 
         
         disk_height=50, 
-        bulge_height=150
+        bulge_height=150,
+        
+        seed=seed,
+        workers=options.workers
         )
     
     print "Computing regions..."
-    regions.compute_regions(star_array, edge_data)
+    hierarchy = regions.compute_regions(star_array, edge_data)
     
     serialize.save(star_array, edge_data, options.filename)
+    serialize.save_hierarchy(hierarchy, options.filename + serialize.hierarchy_extension)
     
     print "Rendering..."
     printer.print_galaxy(star_array, edge_data)
     
     
     
+def run_ensemble(options):
+    import ensemble
+    from utils import paramgrid
+    
+    config = paramgrid.load_config(options.config)
+    ensemble.run_ensemble(config, options.count, options.output, workers=options.workers, first_seed=options.seed)
+    
+
+def run_stream(options):
+    import stream_generator
+    
+    stream_generator.stream_generate_galaxy(options.output,
+        num_stars=options.stars,
+        galaxy_radius=options.radius,
+        
+        spiral_arm_count=6,
+        spiral_tightness=.5,
+        
+        disk_height=50,
+        bulge_height=150,
+        
+        tile_stars=options.tile_stars,
+        seed=options.seed
+        )
+    
+    
 def run_layout(options):
     import layout
     
     star_array, edge_data = serialize.load(options.filename)
     
+    checkpoint_filename = options.checkpoint or options.filename + serialize.checkpoint_extension
+    
+    #if we're resuming, continue with the settings and iteration count of the run that saved the checkpoint
+    state = None
+    if(options.resume):
+        state = serialize.load_checkpoint(checkpoint_filename)
+        for key, value in state['options'].iteritems():
+            setattr(options, key, value)
+        options.iterations = state['iterations']
+        
+        #keep saving to the checkpoint we just resumed from, even if it was moved and passed with --checkpoint
+        options.checkpoint = checkpoint_filename
+        
+        print "Resuming from iteration %d of %d..."%(state['iteration'], state['iterations'])
+    
+    #save the options that affect the layout along with each checkpoint, so that resuming doesn't depend on passing them again
+    #this includes the checkpoint schedule, so that a resumed run keeps saving checkpoints
+    checkpoint_options = {key:getattr(options, key) for key in ['engine', 'repulsion', 'theta', 'cutoff', 'skin', 'rebuild_iterations', 'workers', 'max_displacement', 'mean_displacement', 'energy_change',
+        'max_step', 'checkpoint_iterations', 'checkpoint_seconds']}
+    checkpoint_options['checkpoint'] = checkpoint_filename
+    def save_checkpoint(checkpoint_state):
+        checkpoint_state['options'] = checkpoint_options
+        serialize.save_checkpoint(checkpoint_state, checkpoint_filename)
+    
+    convergence = None
+    if(options.max_displacement is not None or options.mean_displacement is not None or options.energy_change is not None):
+        convergence = layout.ConvergenceCriteria(options.max_displacement, options.mean_displacement, options.energy_change)
+    
+    trace = None
+    if(options.trace is not None):
+        import telemetry
+        
+        #when resuming, add on to the trace from the interrupted run
+        trace = telemetry.LayoutTrace(options.trace, append=options.resume)
+    
+    checkpoint = None
+    if(options.checkpoint_iterations > 0 or options.checkpoint_seconds > 0):
+        checkpoint = layout.CheckpointSchedule(save_checkpoint, options.checkpoint_iterations, options.checkpoint_seconds)
+    
+    #the coarse layout only moves the starting positions, so there's no point in running it again when resuming
+    if(options.coarse_iterations > 0 and state is None):
+        print "Running coarse layout..."
+        layout.coarse_layout(star_array, edge_data, iterations=options.coarse_iterations, theta=options.theta)
+    
     print "Running layout..."
-    layout.forced_directed_layout(star_array, edge_data, iterations=options.iterations)
+    if(options.engine == 'numpy'):
+        import numpy_layout
+        
+        if(options.repulsion == 'barnes-hut' or options.workers > 1):
+            raise ValueError("The numpy layout engine only supports exact or cutoff repulsion on a single process")
+        
+        stop_reason = numpy_layout.forced_directed_layout(star_array, edge_data, iterations=options.iterations,
+            repulsion=options.repulsion, cutoff=options.cutoff, skin=options.skin, rebuild_iterations=options.rebuild_iterations,
+            state=state, checkpoint=checkpoint, convergence=convergence, trace=trace, max_step=options.max_step)
+    else:
+        if(options.repulsion == 'cutoff'):
+            raise ValueError("Cutoff repulsion is only supported by the numpy layout engine")
+        
+        stop_reason = layout.forced_directed_layout(star_array, edge_data, iterations=options.iterations, repulsion=options.repulsion, theta=options.theta, workers=options.workers, state=state, checkpoint=checkpoint, convergence=convergence, trace=trace, max_step=options.max_step)
+    
+    print "Layout stopped: %s"%stop_reason
+    
+    if(trace is not None):
+        trace.close()
+    
+    serialize.save(star_array, edge_data, options.filename)
+    
+    #the run finished, so the checkpoint is no longer needed
+    if(os.path.exists(checkpoint_filename)):
+        os.remove(checkpoint_filename)
+    
+    
+
+def run_relax(options):
+    import layout
+    
+    star_array, edge_data = serialize.load(options.filename)
+    
+    convergence = None
+    if(options.max_displacement is not None):
+        convergence = layout.ConvergenceCriteria(max_displacement=options.max_displacement)
+    
+    stop_reason = layout.relax_layout(star_array, edge_data, options.stars, hops=options.hops, iterations=options.iterations, theta=options.theta, convergence=convergence)
+    print "Layout stopped: %s"%stop_reason
     
     serialize.save(star_array, edge_data, options.filename)
     
+
+def run_sweep(options):
+    import sweep
+    from utils import paramgrid
+    
+    config = paramgrid.load_config(options.config)
+    sweep.run_sweep(options.filename, config, options.output, workers=options.workers)
+    
+
+def run_tracereport(options):
+    import telemetry
     
+    for filename in options.input:
+        telemetry.print_trace_report(filename)
     
 
 def run_render(options):
@@ -62,10 +191,18 @@ def run_regions(options):
     
     star_array, edge_data = serialize.load(options.filename)
     
+    #continue from the passes stored by the last time regions were computed, unless we were asked not to
+    hierarchy_filename = options.filename + serialize.hierarchy_extension
+    hierarchy = None
+    if(not options.recompute):
+        hierarchy = serialize.load_hierarchy(hierarchy_filename)
+    
     print "Computing regions..."
-    regions.compute_regions(star_array, edge_data)
+    hierarchy = regions.compute_regions(star_array, edge_data, constellation_iterations=options.constellation_iterations, region_iterations=options.region_iterations,
+        workers=options.workers, hierarchy=hierarchy)
     
     serialize.save(star_array, edge_data, options.filename)
+    serialize.save_hierarchy(hierarchy, hierarchy_filename)
     
     print "Rendering..."
     printer.print_galaxy(star_array, edge_data)
@@ -78,7 +215,7 @@ def run_centrality(options):
     star_array, edge_data = serialize.load(options.filename)
     
     print "Computing centrality..."
-    centrality.compute_centrality(star_array, edge_data)
+    centrality.compute_centrality(star_array, edge_data, samples=options.samples, workers=options.workers)
     
     serialize.save(star_array, edge_data, options.filename)
     
@@ -93,7 +230,7 @@ def run_security(options):
     star_array, edge_data = serialize.load(options.filename)
     
     print "Computing security..."
-    centrality.compute_security(star_array, edge_data,10,300)
+    centrality.compute_security(star_array, edge_data, 10, options.iterations, tolerance=options.tolerance)
     
     serialize.save(star_array, edge_data, options.filename)
     
@@ -123,7 +260,7 @@ def run_fromsqlite(options):
     import printer
     
     print "Loading from sqlite..."
-    star_array, edge_data = generator.load_sqlite(options.input)
+    star_array, edge_data = generator.load_sqlite(options.input, use_cache=not options.no_cache)
     
     serialize.save(star_array, edge_data, options.filename)
     
@@ -138,12 +275,65 @@ if(__name__ == '__main__'):
     subparsers = parser.add_subparsers(title="Subcommands")
     
     main_parser = subparsers.add_parser('main', help='Generates a new galaxy, renders it, and serializes it')
+    main_parser.add_argument('--seed', help="Random seed. The same seed always generates the same galaxy", type=int, default=None)
+    main_parser.add_argument('-w','--workers', help="Number of processes to generate the galaxy with. This doesn't change the result", type=int, default=1)
     main_parser.set_defaults(func=main)
     
+    ensemble_parser = subparsers.add_parser('ensemble', help='Generates and computes regions for several galaxies for every parameter set in a json config, and summarizes them. See ensemble.py for the config format')
+    ensemble_parser.add_argument('config', help="The json file listing the generator parameters to try", type=str)
+    ensemble_parser.add_argument('-n','--count', help="Number of galaxies to generate for each parameter set", type=int, default=1)
+    ensemble_parser.add_argument('-o','--output', help="Directory to write each galaxy and the summary to", type=str, default='ensemble')
+    ensemble_parser.add_argument('-w','--workers', help="Number of galaxies to generate at once", type=int, default=1)
+    ensemble_parser.add_argument('--seed', help="Seed of the first galaxy. Each galaxy after it uses the next seed", type=int, default=0)
+    ensemble_parser.set_defaults(func=run_ensemble)
+    
+    stream_parser = subparsers.add_parser('stream', help='Generates a galaxy too big to fit in memory, a tile at a time, and writes its star positions and edges to a directory of .npy files')
+    stream_parser.add_argument('-n','--stars', help="Number of stars to generate", type=int, default=10000000)
+    stream_parser.add_argument('-r','--radius', help="Radius of the galaxy", type=float, default=5000)
+    stream_parser.add_argument('-t','--tile-stars', help="Average number of stars in each tile. Peak memory use grows with this", type=int, default=500000)
+    stream_parser.add_argument('-o','--output', help="Directory to write the galaxy to", type=str, default='galaxy')
+    stream_parser.add_argument('--seed', help="Random seed. The same seed always generates the same galaxy", type=int, default=None)
+    stream_parser.set_defaults(func=run_stream)
+    
     layout_parser = subparsers.add_parser('layout', help='Takes an existing star data set and runs iterations of force layout on them. Can be run on pypy, unlike the rest of the galaxy generator modules')
-    layout_parser.add_argument('-i','--iterations', help="Number of iterations to run", type=int, default=1)
+    layout_parser.add_argument('-i','--iterations', help="Number of iterations to run. If any convergence thresholds are given, this is the maximum", type=int, default=1)
+    layout_parser.add_argument('--engine', help="Which layout implementation to use. python can be run on pypy, numpy is faster on cpython", type=str, default='python', choices=['python','numpy'])
+    layout_parser.add_argument('-r','--repulsion', help="How to compute repulsion between stars. exact is O(n^2) per iteration, barnes-hut (python engine only) is O(n log n), and cutoff (numpy engine only) ignores stars further apart than --cutoff", type=str, default='exact', choices=['exact','barnes-hut','cutoff'])
+    layout_parser.add_argument('-t','--theta', help="Opening angle for barnes-hut repulsion. Larger values are faster but less accurate, 0 is exact", type=float, default=0.5)
+    layout_parser.add_argument('--cutoff', help="Distance beyond which cutoff repulsion ignores pairs of stars", type=float, default=200)
+    layout_parser.add_argument('--skin', help="Extra distance beyond the cutoff kept in the cutoff repulsion's neighbor lists, so they don't have to be rebuilt every iteration", type=float, default=20)
+    layout_parser.add_argument('--rebuild-iterations', help="Maximum number of iterations between neighbor list rebuilds for cutoff repulsion", type=int, default=10)
+    layout_parser.add_argument('-w','--workers', help="Number of processes to split the force computation between", type=int, default=1)
+    layout_parser.add_argument('-c','--coarse-iterations', help="Before the full layout, lay out the region and constellation graphs for this many iterations each and move the stars along with them. Only a few full iterations are needed afterwards", type=int, default=0)
+    layout_parser.add_argument('--max-step', help="Limit how far a star can move in one iteration. Stars that get very close to each other can otherwise be flung across the galaxy and make the layout blow up", type=float, default=None)
+    layout_parser.add_argument('--max-displacement', help="Stop once no star moves further than this in an iteration", type=float, default=None)
+    layout_parser.add_argument('--mean-displacement', help="Stop once the average star moves less than this in an iteration", type=float, default=None)
+    layout_parser.add_argument('--energy-change', help="Stop once the total energy changes by less than this fraction in an iteration", type=float, default=None)
+    layout_parser.add_argument('--checkpoint', help="File to save checkpoints to. Defaults to the pickle filename with '%s' appended"%serialize.checkpoint_extension, type=str, default=None)
+    layout_parser.add_argument('--checkpoint-iterations', help="Save a checkpoint every N iterations", type=int, default=0)
+    layout_parser.add_argument('--checkpoint-seconds', help="Save a checkpoint every T seconds", type=float, default=0)
+    layout_parser.add_argument('--resume', help="Continue the layout run that saved the checkpoint, using its settings and iteration count", action='store_true', default=False)
+    layout_parser.add_argument('--trace', help="Write timings and statistics for every iteration to this file, in json lines format", type=str, default=None)
     layout_parser.set_defaults(func=run_layout)
     
+    relax_parser = subparsers.add_parser('relax', help='Re-runs the layout around a few stars that were edited, leaving the rest of the galaxy where it is')
+    relax_parser.add_argument('stars', help="The ids of the stars that were added or had their jumps changed", type=int, nargs='+')
+    relax_parser.add_argument('--hops', help="Stars up to this many jumps away from an edited star are allowed to move", type=int, default=3)
+    relax_parser.add_argument('-i','--iterations', help="Maximum number of iterations to run", type=int, default=100)
+    relax_parser.add_argument('-t','--theta', help="Opening angle used to approximate the repulsion from the stars that don't move", type=float, default=0.5)
+    relax_parser.add_argument('--max-displacement', help="Stop once no star moves further than this in an iteration", type=float, default=None)
+    relax_parser.set_defaults(func=run_relax)
+    
+    sweep_parser = subparsers.add_parser('sweep', help='Lays out the same star data set once for every parameter set in a json config, and compares the results. See sweep.py for the config format')
+    sweep_parser.add_argument('config', help="The json file listing the layout options and constants to try", type=str)
+    sweep_parser.add_argument('-o','--output', help="Directory to write each layout and the summary to", type=str, default='sweep')
+    sweep_parser.add_argument('-w','--workers', help="Number of layouts to run at once", type=int, default=1)
+    sweep_parser.set_defaults(func=run_sweep)
+    
+    tracereport_parser = subparsers.add_parser('tracereport', help='Summarizes one or more layout trace files written by layout --trace')
+    tracereport_parser.add_argument('input', help="The trace files to summarize", type=str, nargs='+')
+    tracereport_parser.set_defaults(func=run_tracereport)
+    
     render_parser = subparsers.add_parser('render', help='Takes an existing star data set and generates an image for it')
     render_parser.add_argument('-e','--edge', help="Print the galaxy edge-on instead of top-down", action='store_true', default=False)
     render_parser.add_argument('-c','--color', help="Chooses which measure to use to color each star", type=str, default='region',choices=['security','region','betweenness','closeness'])
@@ -151,12 +341,20 @@ if(__name__ == '__main__'):
     render_parser.set_defaults(func=run_render)
     
     region_parser = subparsers.add_parser('region', help='Takes an existing star data set and computes regions for it')
+    region_parser.add_argument('--constellation-iterations', help="Number of community passes that make up a constellation", type=int, default=2)
+    region_parser.add_argument('--region-iterations', help="Number of community passes that make up a region. Fewer passes give more, smaller regions", type=int, default=4)
+    region_parser.add_argument('--recompute', help="Compute every community pass again, instead of reusing the passes saved next to the galaxy by the last run", action='store_true')
+    region_parser.add_argument('-w','--workers', help="Number of processes to split the first community pass between. The result is slightly different from the serial one: on generated galaxies its modularity has stayed within 0.002 of it, but that's a measured bound, not a guarantee. See regions.py", type=int, default=1)
     region_parser.set_defaults(func=run_regions)
     
     centrality_parser = subparsers.add_parser('centrality', help='Takes an existing star data set and computes centrality data for it')
+    centrality_parser.add_argument('--samples', help="Approximate betweenness from shortest paths starting at this many random stars, instead of computing current flow betweenness exactly. 0 computes it exactly", type=int, default=0)
+    centrality_parser.add_argument('-w','--workers', help="Number of processes to split the sampled betweenness between", type=int, default=1)
     centrality_parser.set_defaults(func=run_centrality)
     
     security_parser = subparsers.add_parser('security', help='Takes an existing star data set and computes security status data for it')
+    security_parser.add_argument('-i','--iterations', help="Maximum number of steps of the random walk that spreads security out from the seeds. More steps spread it more evenly", type=int, default=300)
+    security_parser.add_argument('--tolerance', help="Stop the random walk early once a step changes it by less than this fraction", type=float, default=1e-4)
     security_parser.set_defaults(func=run_security)
     
     tojson_parser = subparsers.add_parser('tojson', help='Takes an existing star data set and converts it to json format')
@@ -169,6 +367,7 @@ if(__name__ == '__main__'):
     
     fromdump_parser = subparsers.add_parser('fromdump', help="Loads star data from the sqlite form of EVE's static dump")
     fromdump_parser.add_argument('input', help="The static dump filename", type=str)
+    fromdump_parser.add_argument('--no-cache', help="Always read the dump with sqlite, instead of using or writing the cached copy next to it", action='store_true', default=False)
     fromdump_parser.set_defaults(func=run_fromsqlite)
     
     args = parser.parse_args()
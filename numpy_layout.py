@@ -0,0 +1,328 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is a numpy version of the force directed layout in layout.py
+
+Instead of dicts of Vector3D, every vertex is a row in contiguous (n,3) arrays and the edges are stored in CSR form,
+so each iteration is a handful of batched array operations. It uses the same constants as layout.py and gives the same results
+within floating point tolerance, but it can't be run on pypy
+'''
+
+import datetime
+import time
+
+import numpy
+from scipy.spatial import cKDTree as KDTree
+
+import generator
+import layout
+from utils.vector3d import Vector3D
+
+#the exact repulsion builds a (block, n, 3) array of displacements at a time. keep each block around this many floats
+REPULSION_BLOCK_FLOATS = 2**22
+
+#repulsion is either 'exact', which compares every pair of vertices, or 'cutoff', which ignores pairs further apart than cutoff
+#cutoff repulsion keeps a list of every pair within cutoff + skin of each other, and rebuilds it every rebuild_iterations iterations
+#or as soon as a vertex has moved far enough that the list might be missing a pair
+#state, checkpoint, convergence, trace and max_step work the same way as in layout.forced_directed_layout, and checkpoints can be shared between the two
+def forced_directed_layout(star_dict, edge_dict, iterations=1, repulsion='exact', cutoff=200, skin=20, rebuild_iterations=10, state=None, checkpoint=None, convergence=None, trace=None, max_step=None):
+
+    node_keys = star_dict.keys()
+
+    #the forces that were computed on the previous frame, or None if there wasn't one
+    previous_forces = None
+
+    timestep = layout.INITIAL_TIMESTEP
+    swing_tolerance = layout.SWING_TOLERANCE
+    printstep = int((100.0 / (len(star_dict)**2)) * 1000.0) or 1
+
+    #the total energy of the previous frame, ie the sum of the squared force on every vertex
+    previous_energy = None
+
+    #if we're resuming, pick up the positions, swing data and timestep exactly where the checkpoint left them
+    first_iteration = 0
+    if(state is not None):
+        layout.restore_positions(star_dict, state)
+        if(len(state['previous_forces']) > 0):
+            previous_forces = numpy.array([state['previous_forces'][k] for k in node_keys], dtype=numpy.float64)
+        previous_energy = state['energy']
+        timestep = state['timestep']
+        first_iteration = state['iteration']
+
+    stop_reason = "completed %d iterations"%iterations
+
+    positions, region_ids, indptr, indices = build_arrays(node_keys, star_dict, edge_dict)
+
+    #for each edge, store the index of the vertex it starts from. this lets us sum per-edge forces into per-vertex forces
+    edge_rows = numpy.repeat(numpy.arange(len(node_keys)), numpy.diff(indptr))
+    same_region = region_ids[edge_rows] == region_ids[indices]
+
+    if(repulsion == 'cutoff'):
+        neighbor_list = NeighborList(cutoff, skin, rebuild_iterations)
+
+    if(printstep < iterations):
+        print "0%"
+
+    start_time = datetime.datetime.now()
+    for i in xrange(first_iteration, iterations):
+        #compute the forces for this frame
+        attraction_start = time.time()
+        current_forces = compute_global_force(positions, **layout.GLOBAL_CONSTANTS)
+        current_forces += compute_attraction_force(positions, edge_rows, indices, same_region, **layout.ATTRACTION_CONSTANTS)
+
+        repulsion_start = time.time()
+        if(repulsion == 'cutoff'):
+            current_forces += compute_cutoff_repel_force(positions, neighbor_list.get_pairs(positions), cutoff, **layout.REPULSION_CONSTANTS)
+        else:
+            current_forces += compute_repel_force(positions, **layout.REPULSION_CONSTANTS)
+
+        integration_start = time.time()
+        mean_swing = None
+
+        if(previous_forces is not None):
+            #compute the dot product of each vertex's normalized current force with its normalized previous force
+            swing_dot = compute_swing(previous_forces, current_forces)
+            mean_swing = float(swing_dot.mean())
+
+            #use the current and previous force data to update the global speed
+            timestep = update_timestep(timestep, swing_dot, swing_tolerance)
+
+            #each vertex gets a local timestep close to 0 if it's swinging back and forth, and close to the global timestep if it isn't
+            #rounding error can push the dot product slightly below -1
+            local_timestep = timestep * numpy.sqrt(numpy.maximum(swing_dot + 1, 0) * 0.5)
+            steps = current_forces * local_timestep[:,numpy.newaxis]
+        else:
+            steps = current_forces * timestep
+
+        step_length = limit_steps(steps, max_step)
+        positions += steps
+
+        integration_end = time.time()
+
+        force_length_sq = numpy.einsum('ij,ij->i', current_forces, current_forces)
+        energy = float(force_length_sq.sum())
+
+        if(trace is not None):
+            trace.record(
+                iteration=i + 1,
+                attraction_seconds=repulsion_start - attraction_start,
+                repulsion_seconds=integration_start - repulsion_start,
+                integration_seconds=integration_end - integration_start,
+                timestep=timestep,
+                mean_swing=mean_swing,
+                total_force=float(numpy.sqrt(force_length_sq).sum()),
+                energy=energy,
+                max_displacement=float(step_length.max()),
+                mean_displacement=float(step_length.mean()),
+                )
+
+        previous_forces = current_forces
+
+        if(i % printstep == 0):
+            layout.print_progress(i, iterations, start_time, timestep, first_iteration)
+
+        if(checkpoint is not None and checkpoint.is_due(i + 1)):
+            copy_positions(star_dict, node_keys, positions)
+            checkpoint.save(layout.create_state(star_dict, to_vector_dict(node_keys, previous_forces), energy, timestep, i + 1, iterations))
+
+        if(convergence is not None):
+            converged = convergence.check(energy, previous_energy, float(step_length.max()), float(step_length.mean()))
+            if(converged is not None):
+                stop_reason = "converged after %d iterations: %s"%(i + 1, converged)
+                break
+        previous_energy = energy
+
+    copy_positions(star_dict, node_keys, positions)
+
+    return stop_reason
+
+
+def copy_positions(star_dict, node_keys, positions):
+    for k, position in zip(node_keys, positions.tolist()):
+        star_dict[k]['position'] = Vector3D(*position)
+
+def to_vector_dict(node_keys, vectors):
+    return {k:Vector3D(*v) for k, v in zip(node_keys, vectors.tolist())}
+
+
+def build_arrays(node_keys, star_dict, edge_dict):
+    positions = numpy.array([star_dict[k]['position'] for k in node_keys], dtype=numpy.float64)
+
+    #regions can be any hashable value, so relabel them to integers to compare them in bulk
+    region_to_id = {}
+    region_ids = numpy.array([region_to_id.setdefault(star_dict[k]['region'], len(region_to_id)) for k in node_keys], dtype=numpy.int64)
+
+    #the neighbors of vertex i are indices[indptr[i]:indptr[i+1]]
+    indptr, indices = generator.edge_dict_to_csr(node_keys, edge_dict)
+
+    return positions, region_ids, indptr, indices
+
+
+def compute_global_force(positions, center_constant, plane_constant):
+
+    #compute attraction to the center
+    forces = positions * (center_constant * -1)
+
+    #compute attraction to the XZ plane
+    forces[:,1] -= positions[:,1] * plane_constant
+
+    return forces
+
+
+def compute_attraction_force(positions, edge_rows, edge_columns, same_region, log_constant, linear_constant, quad_constant, cubic_constant, different_region_multiplier):
+
+    displacement = positions[edge_columns] - positions[edge_rows]
+
+    distance_sq = numpy.einsum('ij,ij->i', displacement, displacement)
+    distance = numpy.sqrt(distance_sq)
+
+    #we will multiply each displacement vector by this multiplier, see layout.compute_attraction_force
+    multiplier = numpy.zeros(len(distance))
+
+    if(log_constant != 0):
+        multiplier += numpy.log(distance) * log_constant / distance
+
+    if(linear_constant != 0):
+        multiplier += linear_constant
+
+    if(quad_constant != 0):
+        multiplier += distance * quad_constant
+
+    if(cubic_constant != 0):
+        multiplier += distance_sq * cubic_constant
+
+    multiplier[~same_region] *= different_region_multiplier
+
+    return sum_per_vertex(displacement * multiplier[:,numpy.newaxis], edge_rows, len(positions))
+
+
+def compute_repel_force(positions, linear_constant, quad_constant, cubic_constant):
+
+    forces = numpy.empty_like(positions)
+
+    #computing every pair at once would take n^2 memory, so do it a block of rows at a time
+    block_size = max(1, REPULSION_BLOCK_FLOATS // (3 * len(positions)))
+    for start in xrange(0, len(positions), block_size):
+        end = min(start + block_size, len(positions))
+
+        displacement = positions[numpy.newaxis,:,:] - positions[start:end,numpy.newaxis,:]
+        forces[start:end] = sum_repulsion(displacement, linear_constant, quad_constant, cubic_constant)
+
+    return forces
+
+
+#given a (rows, others, 3) array of displacements, compute the total repulsion on each row
+#a vertex's displacement to itself is 0, so it doesn't contribute any force
+def sum_repulsion(displacement, linear_constant, quad_constant, cubic_constant):
+
+    distance_sq = numpy.einsum('ijk,ijk->ij', displacement, displacement)
+    multiplier = compute_repel_multiplier(distance_sq, linear_constant, quad_constant, cubic_constant)
+
+    return numpy.einsum('ij,ijk->ik', multiplier, displacement)
+
+
+#only compute repulsion between the given pairs of vertices, ignoring any that are further apart than cutoff
+def compute_cutoff_repel_force(positions, pairs, cutoff, linear_constant, quad_constant, cubic_constant):
+
+    displacement = positions[pairs[:,1]] - positions[pairs[:,0]]
+    distance_sq = numpy.einsum('ij,ij->i', displacement, displacement)
+
+    in_range = distance_sq <= cutoff * cutoff
+    rows = pairs[in_range,0]
+    columns = pairs[in_range,1]
+
+    multiplier = compute_repel_multiplier(distance_sq[in_range], linear_constant, quad_constant, cubic_constant)
+    pair_forces = displacement[in_range] * multiplier[:,numpy.newaxis]
+
+    #each pair is only listed once, and the force on the second vertex is the opposite of the force on the first
+    return sum_per_vertex(pair_forces, rows, len(positions)) - sum_per_vertex(pair_forces, columns, len(positions))
+
+
+#a verlet list: every pair of vertices within cutoff + skin of each other. as long as no vertex has moved more than skin/2 since the list was built,
+#no pair that's missing from the list can have gotten within cutoff of each other
+class NeighborList(object):
+    def __init__(self, cutoff, skin, rebuild_iterations):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.rebuild_iterations = rebuild_iterations
+
+        self.pairs = None
+        self.built_positions = None
+        self.age = 0
+
+    def get_pairs(self, positions):
+        if(self.pairs is None or self.age >= self.rebuild_iterations or self.max_displacement(positions) > self.skin * 0.5):
+            self.pairs = KDTree(positions).query_pairs(self.cutoff + self.skin, output_type='ndarray')
+            self.built_positions = positions.copy()
+            self.age = 0
+
+        self.age += 1
+        return self.pairs
+
+    def max_displacement(self, positions):
+        displacement = positions - self.built_positions
+        return numpy.sqrt(numpy.einsum('ij,ij->i', displacement, displacement).max())
+
+
+#the repulsion multiplier for each distance, see layout.compute_repel_force
+def compute_repel_multiplier(distance_sq, linear_constant, quad_constant, cubic_constant):
+
+    distance_sq = numpy.maximum(distance_sq, layout.MIN_DISTANCE_SQ)
+
+    multiplier = numpy.zeros(distance_sq.shape)
+
+    if(linear_constant != 0):
+        multiplier -= linear_constant / distance_sq
+
+    if(quad_constant != 0):
+        multiplier -= quad_constant / (numpy.sqrt(distance_sq) * distance_sq)
+
+    if(cubic_constant != 0):
+        multiplier -= cubic_constant / (distance_sq * distance_sq)
+
+    return multiplier
+
+
+def sum_per_vertex(values, rows, num_vertices):
+    #numpy.bincount is much faster than numpy.add.at, but only works on one column at a time
+    return numpy.column_stack([numpy.bincount(rows, weights=values[:,axis], minlength=num_vertices) for axis in xrange(values.shape[1])])
+
+
+#if max_step is given, scale down any step longer than it in place, see layout.apply_forces. returns the length of each step
+def limit_steps(steps, max_step=None):
+    step_length = numpy.sqrt(numpy.einsum('ij,ij->i', steps, steps))
+
+    if(max_step is not None):
+        too_long = step_length > max_step
+
+        steps[too_long] *= (max_step / step_length[too_long])[:,numpy.newaxis]
+        step_length[too_long] = max_step
+    return step_length
+
+
+def compute_swing(previous_forces, current_forces):
+    previous_length = numpy.sqrt(numpy.einsum('ij,ij->i', previous_forces, previous_forces))
+    current_length = numpy.sqrt(numpy.einsum('ij,ij->i', current_forces, current_forces))
+
+    return numpy.einsum('ij,ij->i', previous_forces, current_forces) / (previous_length * current_length)
+
+
+#the same as layout.update_timestep, except that the per-vertex dot products have already been computed
+def update_timestep(timestep, swing_dot, swing_tolerance):
+    dot_average = numpy.mean(swing_dot)
+
+    #rounding error can push the average slightly past 1, which acos can't handle
+    multiplier = 1 - numpy.arccos(numpy.clip(dot_average, -1, 1)) / numpy.pi + swing_tolerance
+
+    new_timestep = timestep * multiplier
+
+    #we don't want the timestep to increase/decrease too quickly - limit it to 20% up or down
+    if(abs(new_timestep - timestep) / timestep > 0.2):
+        if(new_timestep > timestep):
+            return timestep * 1.2
+        else:
+            return timestep * 0.8
+    else:
+        return float(new_timestep)
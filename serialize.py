@@ -3,12 +3,15 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import os
 import cPickle as pickle
 
 from utils.vector3d import Vector3D
 
 default_json_filename = 'stars.json'
 default_pickle_filename = 'stars.pickle'
+checkpoint_extension = '.checkpoint'
+hierarchy_extension = '.regions'
 
 def load(filename):
     with open(filename, 'r') as datafile:
@@ -21,6 +24,39 @@ def save(star_array, edge_dict, filename):
     with open(filename, 'w') as datafile:
         pickle.dump({'vertices':star_array, 'edges':edge_dict}, datafile)
         
+
+def load_checkpoint(filename):
+    with open(filename, 'rb') as datafile:
+        return pickle.load(datafile)
+
+def save_checkpoint(state, filename):
+    atomic_pickle(state, filename)
+        
+        
+
+#the community hierarchy from regions.compute_regions. returns None if there isn't one
+def load_hierarchy(filename):
+    if(not os.path.exists(filename)):
+        return None
+    
+    with open(filename, 'rb') as datafile:
+        return pickle.load(datafile)
+
+def save_hierarchy(hierarchy, filename):
+    atomic_pickle(hierarchy, filename)
+        
+        
+#call write_func with a binary file to write to, and only replace filename once it's done
+#writing to a temporary file and then renaming it means being killed halfway through a save doesn't destroy the previous file
+def atomic_write(filename, write_func):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as datafile:
+        write_func(datafile)
+    os.rename(temp_filename, filename)
+    
+def atomic_pickle(obj, filename):
+    atomic_write(filename, lambda datafile: pickle.dump(obj, datafile, pickle.HIGHEST_PROTOCOL))
+        
         
 def load_json(filename):
     
@@ -0,0 +1,328 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for generating galaxies that are too big to hold in memory all at once
+
+Stars are generated in chunks and written straight to disk, then sorted into spatial tiles with roughly the same number of stars each.
+Edges are built one tile at a time: each tile's stars are loaded along with a halo of nearby stars from the surrounding tiles,
+which is made wide enough that every star's nearest neighbors are found even if they're in another tile.
+
+The result is a directory of .npy files, in the same array format as generator.generate_galaxy_arrays: positions is an (n,3) array,
+and the neighbors of star i are indices[indptr[i]:indptr[i+1]]. Use load_galaxy_store to open them as memory mapped arrays.
+Peak memory is a few arrays of one number per star, plus whatever one tile and its halo need
+'''
+
+import datetime
+import json
+import math
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+from scipy.spatial import cKDTree as KDTree
+
+import generator
+
+POSITIONS_FILENAME = 'positions.npy'
+INDPTR_FILENAME = 'indptr.npy'
+INDICES_FILENAME = 'indices.npy'
+INFO_FILENAME = 'galaxy.json'
+
+#the number of stars sampled to decide where the tile boundaries go
+TILE_SAMPLE_SIZE = 200000
+
+#the number of stars or edges to hold in memory at once when copying between files
+CHUNK_SIZE = 1000000
+
+#the random streams used to place the tile boundaries and to pick each tile's edges. see generator.chunk_random_state
+TILE_SAMPLE_STREAM = 20
+TILE_EDGE_STREAM = 21
+
+def stream_generate_galaxy(directory, num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height, tile_stars=500000, seed=None):
+    if(seed is None):
+        seed = generator.random_seed()
+
+    if(not os.path.isdir(directory)):
+        os.makedirs(directory)
+
+    raw_positions_filename = os.path.join(directory, 'positions.raw.npy')
+    tiled_positions_filename = os.path.join(directory, 'positions.tiled.npy')
+    edges_filename = os.path.join(directory, 'edges.raw')
+    indices_filename = os.path.join(directory, 'indices.raw.npy')
+
+    start_time = datetime.datetime.now()
+
+    print "Generating %d stars..."%num_stars
+    populations = generator.star_populations(num_stars, spiral_arm_count, spiral_tightness, galaxy_radius, bulge_height, disk_height)
+    write_star_positions(raw_positions_filename, num_stars, populations, seed)
+
+    print "Sorting stars into tiles..."
+    raw_positions = numpy.load(raw_positions_filename, mmap_mode='r')
+    tiles = compute_tiles(raw_positions, tile_stars, generator.chunk_random_state(seed, TILE_SAMPLE_STREAM, 0))
+    tile_starts = sort_into_tiles(raw_positions, tiles, tiled_positions_filename)
+    del raw_positions
+    os.remove(raw_positions_filename)
+
+    positions = numpy.load(tiled_positions_filename, mmap_mode='r')
+    with open(edges_filename, 'wb') as edge_file:
+        for t in xrange(len(tiles)):
+            print "Building edges for tile %d of %d..."%(t + 1, len(tiles))
+
+            distance_data, index_data = find_tile_neighbors(positions, tiles, tile_starts, t)
+            acceptance = generator.draw_edge_acceptance(generator.chunk_random_state(seed, TILE_EDGE_STREAM, t), len(index_data), generator.NEIGHBOR_COUNT)
+            sources, targets = generator.sample_edges(distance_data, index_data, acceptance)
+
+            numpy.column_stack((sources, targets)).astype(numpy.int64).tofile(edge_file)
+
+    print "Building adjacency..."
+    edges = numpy.memmap(edges_filename, dtype=numpy.int64, mode='r').reshape(-1, 2)
+    indptr, indices = build_csr(edges, num_stars, indices_filename)
+    del edges
+    os.remove(edges_filename)
+
+    print "Removing disconnected stars..."
+    keep = generator.find_largest_component(indptr, indices)
+    num_edges = write_pruned_store(directory, positions, indptr, indices, keep)
+    del positions, indices
+    os.remove(tiled_positions_filename)
+    os.remove(indices_filename)
+
+    info = {
+        'num_stars': int(keep.sum()),
+        'num_edges': num_edges / 2,
+        'num_tiles': len(tiles),
+        'seed': seed,
+        'parameters': dict(
+            num_stars=num_stars,
+            spiral_arm_count=spiral_arm_count,
+            spiral_tightness=spiral_tightness,
+            galaxy_radius=galaxy_radius,
+            bulge_height=bulge_height,
+            disk_height=disk_height,
+            ),
+        }
+    with open(os.path.join(directory, INFO_FILENAME), 'w') as datafile:
+        json.dump(info, datafile, indent=2, sort_keys=True)
+
+    print "Wrote %d stars and %d edges in %s"%(info['num_stars'], info['num_edges'], str(datetime.datetime.now() - start_time))
+    return info
+
+
+#returns the positions, indptr and indices arrays of a galaxy store, memory mapped so that they're only read from disk as they're used
+def load_galaxy_store(directory, mmap_mode='r'):
+    return tuple(numpy.load(os.path.join(directory, filename), mmap_mode=mmap_mode) for filename in [POSITIONS_FILENAME, INDPTR_FILENAME, INDICES_FILENAME])
+
+
+#the stars are drawn in the same chunks as generator.sample_star_positions, so they come out exactly the same for the same seed
+def write_star_positions(filename, num_stars, populations, seed):
+    positions = open_memmap(filename, mode='w+', dtype=numpy.float64, shape=(num_stars, 3))
+
+    start = 0
+    for stream, chunk, count, sample_func in generator.population_chunks(populations):
+        positions[start:start + count] = generator.sample_star_chunk((seed, stream, chunk, count, sample_func))
+        start += count
+
+    positions.flush()
+
+
+#split the galaxy into tiles with about tile_stars stars each, by cutting it into slabs along the x axis and then cutting each slab along the z axis
+#the galaxy is a thin disk, so there's no need to cut along y. the boundaries are placed at quantiles of a random sample of the stars
+#returns a list of (x_min, x_max, z_min, z_max) tuples. the tiles on the outside extend to infinity
+def compute_tiles(positions, tile_stars, random_state):
+    num_tiles = max(1, int(math.ceil(len(positions) / float(tile_stars))))
+    num_slabs = max(1, int(round(math.sqrt(num_tiles))))
+    tiles_per_slab = int(math.ceil(num_tiles / float(num_slabs)))
+
+    sample_ids = numpy.sort(random_state.randint(0, len(positions), min(len(positions), TILE_SAMPLE_SIZE)))
+    sample = numpy.array(positions[sample_ids])
+
+    x_bounds = quantile_bounds(sample[:,0], num_slabs)
+
+    tiles = []
+    for x_min, x_max in zip(x_bounds[:-1], x_bounds[1:]):
+        slab_sample = sample[(sample[:,0] >= x_min) & (sample[:,0] < x_max)]
+        z_bounds = quantile_bounds(slab_sample[:,2], tiles_per_slab)
+
+        tiles.extend((x_min, x_max, z_min, z_max) for z_min, z_max in zip(z_bounds[:-1], z_bounds[1:]))
+    return tiles
+
+
+#returns count + 1 boundaries that split the values into count groups of about the same size, starting at -inf and ending at inf
+def quantile_bounds(values, count):
+    if(len(values) > 0):
+        inner = numpy.percentile(values, numpy.linspace(0, 100, count + 1)[1:-1]).tolist()
+    else:
+        inner = [0.0] * (count - 1)
+    return [-numpy.inf] + inner + [numpy.inf]
+
+
+#write the stars to filename sorted by tile, so that each tile's stars are a contiguous range of rows
+#returns an array where tile t is rows tile_starts[t] to tile_starts[t+1]
+def sort_into_tiles(positions, tiles, filename):
+    tile_ids = numpy.empty(len(positions), dtype=numpy.int32)
+    for start in xrange(0, len(positions), CHUNK_SIZE):
+        chunk = numpy.array(positions[start:start + CHUNK_SIZE])
+        tile_ids[start:start + len(chunk)] = find_tile_ids(chunk, tiles)
+
+    order = numpy.argsort(tile_ids, kind='mergesort')
+    tile_starts = numpy.zeros(len(tiles) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(tile_ids, minlength=len(tiles)), out=tile_starts[1:])
+    del tile_ids
+
+    sorted_positions = open_memmap(filename, mode='w+', dtype=numpy.float64, shape=positions.shape)
+    for start in xrange(0, len(positions), CHUNK_SIZE):
+        chunk_order = order[start:start + CHUNK_SIZE]
+
+        #reading the rows in file order is much faster than reading them in tile order
+        read_order = numpy.argsort(chunk_order)
+        sorted_positions[start + read_order] = positions[chunk_order[read_order]]
+    sorted_positions.flush()
+
+    return tile_starts
+
+
+def find_tile_ids(positions, tiles):
+    tile_ids = numpy.empty(len(positions), dtype=numpy.int32)
+    for t, (x_min, x_max, z_min, z_max) in enumerate(tiles):
+        in_tile = (positions[:,0] >= x_min) & (positions[:,0] < x_max) & (positions[:,2] >= z_min) & (positions[:,2] < z_max)
+        tile_ids[in_tile] = t
+    return tile_ids
+
+
+#find the nearest neighbors of every star in tile t, in the same form as a KDTree query over the whole galaxy
+def find_tile_neighbors(positions, tiles, tile_starts, t):
+    start, end = tile_starts[t], tile_starts[t + 1]
+    tile_positions = numpy.array(positions[start:end])
+
+    #tile boundaries come from quantiles, so on a small galaxy some tiles can be empty
+    if(len(tile_positions) == 0):
+        return numpy.zeros((0, generator.NEIGHBOR_COUNT)), numpy.zeros((0, generator.NEIGHBOR_COUNT), dtype=numpy.int64)
+
+    #start by only looking at the stars in this tile
+    distance_data, index_data = KDTree(tile_positions).query(tile_positions, k=generator.NEIGHBOR_COUNT, eps=generator.NEIGHBOR_EPS)
+    index_data += start
+
+    #a star's neighbors are all in this tile if its furthest neighbor is closer than the edge of the tile
+    #for every other star, look again with a halo around the tile as wide as the furthest neighbor distance of any of them
+    #the halo only adds stars, so no neighbor can get further away, and every star is at least the halo width from the edge of the halo
+    unsure = ~(distance_data[:,-1] <= distance_to_tile_edge(tile_positions, tiles[t]))
+    if(unsure.any()):
+        halo_width = distance_data[unsure, -1].max() * 1.01
+        halo_ids = find_halo_stars(positions, tiles, tile_starts, t, halo_width)
+
+        halo_distances, halo_indexes = KDTree(positions[halo_ids]).query(tile_positions[unsure], k=generator.NEIGHBOR_COUNT, eps=generator.NEIGHBOR_EPS)
+
+        #missing neighbors get the index one past the end, so they have to be mapped separately. their infinite distance keeps them from becoming edges
+        distance_data[unsure] = halo_distances
+        index_data[unsure] = numpy.append(halo_ids, len(positions))[halo_indexes]
+
+    return distance_data, index_data
+
+
+#the distance in the x-z plane from each position to the nearest edge of the tile
+def distance_to_tile_edge(positions, tile):
+    x_min, x_max, z_min, z_max = tile
+    return numpy.min([positions[:,0] - x_min, x_max - positions[:,0], positions[:,2] - z_min, z_max - positions[:,2]], axis=0)
+
+
+#returns the ids of every star within halo_width of tile t in the x-z plane, including the stars in the tile
+def find_halo_stars(positions, tiles, tile_starts, t, halo_width):
+    x_min, x_max, z_min, z_max = tiles[t]
+    x_min, x_max, z_min, z_max = x_min - halo_width, x_max + halo_width, z_min - halo_width, z_max + halo_width
+
+    halo_ids = []
+    for other, (other_x_min, other_x_max, other_z_min, other_z_max) in enumerate(tiles):
+        if(other_x_min <= x_max and other_x_max >= x_min and other_z_min <= z_max and other_z_max >= z_min):
+            start, end = tile_starts[other], tile_starts[other + 1]
+            other_positions = numpy.array(positions[start:end])
+
+            in_halo = (other_positions[:,0] >= x_min) & (other_positions[:,0] <= x_max) & (other_positions[:,2] >= z_min) & (other_positions[:,2] <= z_max)
+            halo_ids.append(numpy.flatnonzero(in_halo) + start)
+
+    return numpy.concatenate(halo_ids)
+
+
+#build a symmetric CSR adjacency with no duplicates from an (m,2) array of edges, a chunk at a time
+#the indices are written to filename, and only the first indptr[-1] of them are used
+def build_csr(edges, num_vertices, filename):
+
+    #count both directions of every edge, including duplicates
+    degrees = numpy.zeros(num_vertices, dtype=numpy.int64)
+    for start in xrange(0, len(edges), CHUNK_SIZE):
+        chunk = numpy.array(edges[start:start + CHUNK_SIZE])
+        degrees += numpy.bincount(chunk.ravel(), minlength=num_vertices)
+
+    indptr = numpy.zeros(num_vertices + 1, dtype=numpy.int64)
+    numpy.cumsum(degrees, out=indptr[1:])
+    del degrees
+
+    #copy each edge into the next free slot of its source's row
+    indices = open_memmap(filename, mode='w+', dtype=numpy.int64, shape=(max(1, indptr[-1]),))
+    next_free = indptr[:-1].copy()
+    for start in xrange(0, len(edges), CHUNK_SIZE):
+        chunk = numpy.array(edges[start:start + CHUNK_SIZE])
+        rows = numpy.concatenate((chunk[:,0], chunk[:,1]))
+        columns = numpy.concatenate((chunk[:,1], chunk[:,0]))
+
+        order = numpy.argsort(rows, kind='mergesort')
+        rows = rows[order]
+        columns = columns[order]
+
+        #the position of each edge among the edges in this chunk with the same source
+        rank = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+        indices[next_free[rows] + rank] = columns
+        next_free += numpy.bincount(rows, minlength=num_vertices)
+    del next_free
+
+    #sort and remove duplicates from a block of rows at a time. the rows only get shorter, so they can be written back to the same file
+    new_indptr = numpy.zeros(num_vertices + 1, dtype=numpy.int64)
+    row_start = 0
+    while(row_start < num_vertices):
+        row_end = max(row_start + 1, numpy.searchsorted(indptr, indptr[row_start] + CHUNK_SIZE, side='right') - 1)
+        row_end = min(row_end, num_vertices)
+
+        block = numpy.array(indices[indptr[row_start]:indptr[row_end]])
+        block_rows = numpy.repeat(numpy.arange(row_end - row_start), numpy.diff(indptr[row_start:row_end + 1]))
+
+        rows, columns = numpy.divmod(numpy.unique(block_rows * num_vertices + block), num_vertices)
+        indices[new_indptr[row_start]:new_indptr[row_start] + len(columns)] = columns
+        numpy.cumsum(numpy.bincount(rows, minlength=row_end - row_start), out=new_indptr[row_start + 1:row_end + 1])
+        new_indptr[row_start + 1:row_end + 1] += new_indptr[row_start]
+
+        row_start = row_end
+    indices.flush()
+
+    return new_indptr, indices[:new_indptr[-1]]
+
+
+#write the final store, keeping only the stars where keep is true and renumbering them from 0, like generator.remove_disconnected_arrays
+#returns the number of indices written
+def write_pruned_store(directory, positions, indptr, indices, keep):
+    new_ids = numpy.cumsum(keep) - 1
+    degrees = numpy.diff(indptr)
+
+    new_indptr = numpy.zeros(int(keep.sum()) + 1, dtype=numpy.int64)
+    numpy.cumsum(degrees[keep], out=new_indptr[1:])
+    numpy.save(os.path.join(directory, INDPTR_FILENAME), new_indptr)
+
+    new_positions = open_memmap(os.path.join(directory, POSITIONS_FILENAME), mode='w+', dtype=numpy.float64, shape=(len(new_indptr) - 1, 3))
+    new_indices = open_memmap(os.path.join(directory, INDICES_FILENAME), mode='w+', dtype=numpy.int64, shape=(new_indptr[-1],))
+
+    for start in xrange(0, len(keep), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, len(keep))
+        chunk_keep = keep[start:end]
+        new_start = new_ids[start - 1] + 1 if start > 0 else 0
+
+        new_positions[new_start:new_start + chunk_keep.sum()] = numpy.array(positions[start:end])[chunk_keep]
+
+        #every neighbor of a kept star is kept too, so only the rows need to be filtered
+        block = numpy.array(indices[indptr[start]:indptr[end]])
+        row_keep = numpy.repeat(chunk_keep, degrees[start:end])
+        new_indices[new_indptr[new_start]:new_indptr[new_start] + row_keep.sum()] = new_ids[block[row_keep]]
+
+    new_positions.flush()
+    new_indices.flush()
+
+    return int(new_indptr[-1])
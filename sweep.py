@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for laying out the same galaxy with many different layout settings, so that they can be compared
+
+Each parameter set from a sweep config is laid out in its own process and saved to its own pickle file, along with how long it took and some statistics
+about how the result looks. Parameter names containing a dot are layout constants, see layout.set_constants. Every other name is a layout option from DEFAULT_OPTIONS
+'''
+
+import os
+import time
+
+import numpy
+from scipy.spatial import cKDTree as KDTree
+
+import layout
+import serialize
+from utils import paramgrid
+
+#the layout options a parameter set can contain, and the value used when it leaves one out. these match the defaults of the layout subcommand
+#except for iterations, since a sweep with a single iteration per run wouldn't tell us much
+DEFAULT_OPTIONS = dict(
+    iterations=100,
+    engine='python',
+    repulsion='exact',
+    theta=0.5,
+    cutoff=200,
+    skin=20,
+    rebuild_iterations=10,
+    coarse_iterations=0,
+    max_displacement=None,
+    mean_displacement=None,
+    energy_change=None,
+    max_step=None,
+    )
+
+#the columns of the summary table, see paramgrid.print_summary
+SUMMARY_COLUMNS = [
+    ('output', -24, 's', lambda result: os.path.basename(result['output'])),
+    ('seconds', 10, '.1f', lambda result: result['seconds']),
+    ('mean length', 12, '.2f', lambda result: result['quality']['edge_length_mean']),
+    ('length cv', 12, '.4f', lambda result: result['quality']['edge_length_cv']),
+    ('crossings', 10, 'd', lambda result: result['quality']['crossings']),
+    ]
+
+def run_sweep(input_filename, config, output_dir, workers=1):
+    #fill in the defaults of every parameter set before starting, so that each result records exactly what it was run with
+    #this also checks every parameter set, so that a typo in the last one doesn't throw away the whole sweep
+    param_sets = [resolve_params(params) for params in paramgrid.expand_config(config)]
+
+    tasks = [(input_filename, params, os.path.join(output_dir, "run%03d.pickle"%i)) for i, params in enumerate(param_sets)]
+    names = paramgrid.varied_names(param_sets)
+
+    print "Running %d layouts on %d processes..."%(len(tasks), workers)
+
+    def describe(result):
+        return "%s finished in %.1fs: %s"%(result['output'], result['seconds'], paramgrid.describe_params(result['params'], names))
+
+    #each process only runs a single layout, so that the constants set for one run can't leak into the next one
+    results = paramgrid.run_tasks(run_sweep_layout, tasks, output_dir, describe, workers=workers, maxtasksperchild=1)
+
+    paramgrid.print_summary(results, SUMMARY_COLUMNS, names)
+    return results
+
+
+#returns a copy of the parameter set with every layout option and layout constant it leaves out set to its default value
+def resolve_params(params):
+    options, constants = split_params(params)
+
+    resolved = dict(options)
+    for group, group_constants in layout.CONSTANT_GROUPS.iteritems():
+        for key, value in group_constants.iteritems():
+            resolved["%s.%s"%(group, key)] = constants.get("%s.%s"%(group, key), value)
+    return resolved
+
+
+#split a parameter set into the layout options and the layout constant overrides. raises ValueError for anything that isn't either
+def split_params(params):
+    options = dict(DEFAULT_OPTIONS)
+    constants = {}
+
+    for name, value in params.iteritems():
+        if('.' in name):
+            group, _, key = name.partition('.')
+            if(key not in layout.CONSTANT_GROUPS.get(group, {})):
+                raise ValueError("Unknown layout constant: %s"%name)
+            constants[name] = value
+        elif(name in options):
+            options[name] = value
+        else:
+            raise ValueError("Unknown sweep parameter: %s"%name)
+
+    if(options['engine'] == 'numpy' and options['repulsion'] == 'barnes-hut'):
+        raise ValueError("The numpy layout engine only supports exact or cutoff repulsion")
+    if(options['engine'] == 'python' and options['repulsion'] == 'cutoff'):
+        raise ValueError("Cutoff repulsion is only supported by the numpy layout engine")
+
+    return options, constants
+
+
+def run_sweep_layout(task):
+    input_filename, params, output_filename = task
+    options, constants = split_params(params)
+
+    layout.set_constants(constants)
+
+    star_dict, edge_dict = serialize.load(input_filename)
+
+    convergence = None
+    if(options['max_displacement'] is not None or options['mean_displacement'] is not None or options['energy_change'] is not None):
+        convergence = layout.ConvergenceCriteria(options['max_displacement'], options['mean_displacement'], options['energy_change'])
+
+    start_time = time.time()
+
+    if(options['coarse_iterations'] > 0):
+        layout.coarse_layout(star_dict, edge_dict, iterations=options['coarse_iterations'], theta=options['theta'])
+
+    if(options['engine'] == 'numpy'):
+        import numpy_layout
+
+        stop_reason = numpy_layout.forced_directed_layout(star_dict, edge_dict, iterations=options['iterations'],
+            repulsion=options['repulsion'], cutoff=options['cutoff'], skin=options['skin'], rebuild_iterations=options['rebuild_iterations'],
+            convergence=convergence, max_step=options['max_step'])
+    else:
+        stop_reason = layout.forced_directed_layout(star_dict, edge_dict, iterations=options['iterations'],
+            repulsion=options['repulsion'], theta=options['theta'], convergence=convergence, max_step=options['max_step'])
+
+    seconds = time.time() - start_time
+
+    serialize.save(star_dict, edge_dict, output_filename)
+
+    return {
+        'output': output_filename,
+        'params': params,
+        'seconds': seconds,
+        'stop_reason': stop_reason,
+        'quality': compute_layout_quality(star_dict, edge_dict),
+        }
+
+
+#statistics about how a finished layout looks: how evenly the jumps are spread out, and how many jumps cross each other on the rendered map
+def compute_layout_quality(star_dict, edge_dict):
+    node_keys = star_dict.keys()
+    key_to_index = {k:i for i, k in enumerate(node_keys)}
+
+    positions = numpy.array([star_dict[k]['position'] for k in node_keys], dtype=numpy.float64)
+
+    #every edge is stored in both directions, so only keep one of them
+    edge_pairs = numpy.array([(key_to_index[v], key_to_index[n]) for v, neighbors in edge_dict.iteritems() for n in neighbors if key_to_index[v] < key_to_index[n]], dtype=numpy.int64).reshape(-1, 2)
+
+    lengths = numpy.sqrt(((positions[edge_pairs[:,1]] - positions[edge_pairs[:,0]])**2).sum(axis=1))
+    mean_length = float(lengths.mean()) if len(lengths) > 0 else 0.0
+
+    #crossings are counted on the same top-down (x, z) view that the renderer draws
+    return {
+        'edges': len(edge_pairs),
+        'edge_length_mean': mean_length,
+        'edge_length_variance': float(lengths.var()) if len(lengths) > 0 else 0.0,
+        'edge_length_cv': float(lengths.std()) / mean_length if mean_length > 0 else 0.0,
+        'crossings': count_crossings(positions[:,[0,2]], edge_pairs),
+        }
+
+
+#count the pairs of 2D line segments that cross each other. segments that share an endpoint are never counted
+def count_crossings(points, edge_pairs):
+    if(len(edge_pairs) < 2):
+        return 0
+
+    starts = points[edge_pairs[:,0]]
+    ends = points[edge_pairs[:,1]]
+    midpoints = (starts + ends) * 0.5
+    half_lengths = numpy.sqrt(((ends - starts)**2).sum(axis=1)) * 0.5
+
+    #two segments can only cross if their midpoints are closer together than the sum of their half lengths
+    #most segments are short, so find the pairs of nearby midpoints with a kdtree, then compare each of the few long segments separately
+    short_limit = numpy.percentile(half_lengths, 95)
+    tree = KDTree(midpoints)
+
+    candidates = [tree.query_pairs(2 * short_limit, output_type='ndarray')]
+    max_half_length = half_lengths.max()
+    for i in numpy.flatnonzero(half_lengths > short_limit):
+        nearby = numpy.array(tree.query_ball_point(midpoints[i], half_lengths[i] + max_half_length), dtype=numpy.int64)
+        candidates.append(numpy.column_stack((numpy.full(len(nearby), i, dtype=numpy.int64), nearby)))
+    candidates = numpy.concatenate(candidates)
+
+    #the same pair can be found more than once, so put each pair in (low, high) order and remove the duplicates
+    first = numpy.minimum(candidates[:,0], candidates[:,1])
+    second = numpy.maximum(candidates[:,0], candidates[:,1])
+    pair_ids = numpy.unique(first * len(edge_pairs) + second)
+    first, second = numpy.divmod(pair_ids, len(edge_pairs))
+
+    a = edge_pairs[first]
+    b = edge_pairs[second]
+    disjoint = (a[:,0] != b[:,0]) & (a[:,0] != b[:,1]) & (a[:,1] != b[:,0]) & (a[:,1] != b[:,1])
+    a = a[disjoint]
+    b = b[disjoint]
+
+    #two segments cross if each one's endpoints are on opposite sides of the other one
+    def orientation(origin, end, point):
+        return (end[:,0] - origin[:,0]) * (point[:,1] - origin[:,1]) - (end[:,1] - origin[:,1]) * (point[:,0] - origin[:,0])
+
+    a_start, a_end, b_start, b_end = points[a[:,0]], points[a[:,1]], points[b[:,0]], points[b[:,1]]
+    crosses = (orientation(a_start, a_end, b_start) * orientation(a_start, a_end, b_end) < 0) & (orientation(b_start, b_end, a_start) * orientation(b_start, b_end, a_end) < 0)
+
+    return int(crosses.sum())
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for recording per-iteration layout telemetry, and for summarizing it afterwards
+
+A trace is a json-lines file with one object per layout iteration. Like layout.py, this has no dependencies outside the standard library
+
+Timings are wall-clock seconds, even when the forces are computed by a pool of workers. The peak memory is only that of the process
+running the layout, and doesn't include the workers
+'''
+
+import json
+import resource
+
+#the per-iteration timings that are written by both layout engines
+TIMING_FIELDS = ['attraction_seconds', 'repulsion_seconds', 'integration_seconds']
+
+class LayoutTrace(object):
+    def __init__(self, filename, append=False):
+        self.datafile = open(filename, 'a' if append else 'w')
+
+    def record(self, **fields):
+        fields['parent_peak_rss_kb'] = peak_rss_kb()
+
+        #flush every line, so the trace is still useful if the layout is killed partway through
+        self.datafile.write(json.dumps(fields, sort_keys=True) + '\n')
+        self.datafile.flush()
+
+    def close(self):
+        self.datafile.close()
+
+
+#the peak resident memory of this process so far, not counting any worker processes. linux reports this in kilobytes
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_trace(filename):
+    with open(filename, 'r') as datafile:
+        return [json.loads(line) for line in datafile if len(line.strip()) > 0]
+
+
+def summarize_trace(records):
+    summary = {'iterations': len(records)}
+
+    for field in TIMING_FIELDS:
+        summary[field] = sum(r[field] for r in records)
+    summary['total_seconds'] = sum(summary[field] for field in TIMING_FIELDS)
+
+    timesteps = [r['timestep'] for r in records]
+    summary['timestep'] = (timesteps[0], timesteps[-1], min(timesteps), max(timesteps))
+
+    #the first iteration of a run has no previous forces, so it has no swing
+    swings = [r['mean_swing'] for r in records if r['mean_swing'] is not None]
+    if(len(swings) > 0):
+        summary['mean_swing'] = (sum(swings) / len(swings), swings[-1])
+    else:
+        summary['mean_swing'] = None
+
+    summary['total_force'] = (records[0]['total_force'], records[-1]['total_force'])
+    summary['energy'] = (records[0]['energy'], records[-1]['energy'])
+    summary['parent_peak_rss_kb'] = max(r['parent_peak_rss_kb'] for r in records)
+
+    return summary
+
+
+def print_trace_report(filename):
+    records = load_trace(filename)
+
+    if(len(records) == 0):
+        print "%s: empty trace"%filename
+        return
+
+    summary = summarize_trace(records)
+    iterations = summary['iterations']
+    total_seconds = summary['total_seconds']
+
+    print "%s: %d iterations, %.2fs"%(filename, iterations, total_seconds)
+
+    for field in TIMING_FIELDS:
+        seconds = summary[field]
+        pct = 100.0 * seconds / total_seconds if total_seconds > 0 else 0
+
+        print "    %-12s %10.2fs %6.1f%% %10.2fms/iteration"%(field.split('_')[0], seconds, pct, 1000.0 * seconds / iterations)
+
+    print "    timestep     first=%.4f last=%.4f min=%.4f max=%.4f"%summary['timestep']
+    if(summary['mean_swing'] is not None):
+        print "    mean swing   average=%.4f last=%.4f"%summary['mean_swing']
+    print "    total force  first=%.6g last=%.6g"%summary['total_force']
+    print "    energy       first=%.6g last=%.6g"%summary['energy']
+    print "    peak rss     %d KB (layout process only, not workers)"%summary['parent_peak_rss_kb']
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This class represents a Barnes-Hut octree over a set of weighted points in 3D space
+
+Each node stores the total mass and center of mass of every point below it, so that a far away group of points
+can be treated as a single heavy point when computing repulsion. Like Vector3D, this has no dependencies so it can run on pypy
+'''
+
+from utils.vector3d import Vector3D
+
+#nodes with this many points or fewer are not split any further
+LEAF_SIZE = 4
+
+#stop splitting at this depth no matter how many points there are, so that points at the same position can't recurse forever
+MAX_DEPTH = 32
+
+class Octree(object):
+    #there will be a lot of these, so don't give each one its own __dict__
+    __slots__ = ('center', 'half_size', 'mass', 'mass_center', 'children', 'points')
+
+    def __init__(self, points, center, half_size, depth=0):
+        self.center = center
+        self.half_size = half_size
+
+        #compute the total mass and the center of mass of every point in this node
+        mass = 0
+        weighted_sum = Vector3D(0,0,0)
+        for position, point_mass in points:
+            mass += point_mass
+            weighted_sum += position * point_mass
+
+        self.mass = mass
+        self.mass_center = weighted_sum * (1.0 / mass)
+
+        if(len(points) <= LEAF_SIZE or depth >= MAX_DEPTH):
+            self.points = points
+            self.children = None
+        else:
+            self.points = None
+
+            #sort the points into the 8 octants of this node
+            buckets = [[] for i in xrange(8)]
+            cx, cy, cz = center
+            for point in points:
+                x, y, z = point[0]
+                buckets[(x > cx) | ((y > cy) << 1) | ((z > cz) << 2)].append(point)
+
+            #create a child for every octant that has at least one point in it
+            child_size = half_size * 0.5
+            self.children = []
+            for octant, bucket in enumerate(buckets):
+                if(len(bucket) > 0):
+                    child_center = Vector3D(
+                        cx + (child_size if octant & 1 else -child_size),
+                        cy + (child_size if octant & 2 else -child_size),
+                        cz + (child_size if octant & 4 else -child_size),
+                        )
+                    self.children.append(Octree(bucket, child_center, child_size, depth + 1))
+
+    @staticmethod
+    def from_points(points):
+        #points is an iterable of (position, mass) pairs. compute a bounding cube that holds all of them
+        points = list(points)
+
+        min_corner = [min(p[0][axis] for p in points) for axis in xrange(3)]
+        max_corner = [max(p[0][axis] for p in points) for axis in xrange(3)]
+
+        center = Vector3D(*[(low + high) * 0.5 for low, high in zip(min_corner, max_corner)])
+        half_size = max((high - low) * 0.5 for low, high in zip(min_corner, max_corner)) or 1.0
+
+        return Octree(points, center, half_size)
+
+    def contains(self, position):
+        size = self.half_size
+        center = self.center
+        return abs(position[0] - center[0]) <= size and abs(position[1] - center[1]) <= size and abs(position[2] - center[2]) <= size
+
+    #sum repulsion_func(displacement) * mass over every point in the tree, approximating far away nodes by their center of mass
+    #a node is approximated if its width divided by its distance is less than theta. theta=0 computes the exact sum
+    def compute_repulsion(self, position, repulsion_func, theta):
+        theta_sq = theta * theta
+
+        force = Vector3D(0,0,0)
+        stack = [self]
+        while(len(stack) > 0):
+            node = stack.pop()
+
+            if(node.children is None):
+                #this is a leaf, so add the force from each point individually
+                #a point at the same position as the one we're computing has a displacement of 0, so it contributes nothing
+                for point_position, point_mass in node.points:
+                    force += repulsion_func(point_position - position) * point_mass
+            else:
+                displacement = node.mass_center - position
+                width = node.half_size * 2
+
+                #never approximate a node that contains the position itself, or it would be repelled by its own mass
+                if(width * width < theta_sq * displacement.length_sq() and not node.contains(position)):
+                    force += repulsion_func(displacement) * node.mass
+                else:
+                    stack.extend(node.children)
+
+        return force
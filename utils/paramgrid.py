@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for turning a parameter grid config file into a list of parameter sets, and for running a task for each of them
+in a pool of processes
+
+A config is a json object. The "grid" entry maps each parameter name to a list of values, and a parameter set is created for every combination of them.
+The "runs" entry is a list of parameter sets to add individually. Every other entry is a parameter shared by all of the parameter sets
+'''
+
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+GRID_KEY = 'grid'
+RUNS_KEY = 'runs'
+
+SUMMARY_FILENAME = 'summary.json'
+
+def load_config(filename):
+    with open(filename, 'r') as datafile:
+        return json.load(datafile)
+
+
+def expand_config(config):
+    base = {k:v for k, v in config.iteritems() if k not in (GRID_KEY, RUNS_KEY)}
+    param_sets = []
+
+    #sort the names so that the parameter sets always come out in the same order
+    grid = config.get(GRID_KEY, {})
+    if(len(grid) > 0):
+        names = sorted(grid.iterkeys())
+        for values in itertools.product(*[grid[name] for name in names]):
+            params = dict(base)
+            params.update(zip(names, values))
+            param_sets.append(params)
+
+    for run in config.get(RUNS_KEY, []):
+        params = dict(base)
+        params.update(run)
+        param_sets.append(params)
+
+    #with no grid and no runs, there's just the one parameter set made of the shared parameters
+    if(len(param_sets) == 0):
+        param_sets.append(base)
+
+    return param_sets
+
+
+#returns the names of the parameters that aren't the same in every parameter set, for labelling results
+def varied_names(param_sets):
+    names = set(name for params in param_sets for name in params.iterkeys())
+
+    return sorted(name for name in names if len(set(json.dumps(params.get(name)) for params in param_sets)) > 1)
+
+
+def describe_params(params, names):
+    return " ".join("%s=%s"%(name, params.get(name)) for name in names)
+
+
+#run func on every task in a pool of worker processes, and save the list of results to SUMMARY_FILENAME in output_dir
+#the results come back in the same order as the tasks, and describe_func turns each one into a line that's printed as soon as it finishes
+#if maxtasksperchild is given, each process is replaced after running that many tasks
+def run_tasks(func, tasks, output_dir, describe_func, workers=1, maxtasksperchild=None):
+    if(not os.path.isdir(output_dir)):
+        os.makedirs(output_dir)
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, maxtasksperchild=maxtasksperchild)
+    results = []
+    try:
+        for result in pool.imap(func, tasks):
+            results.append(result)
+            print describe_func(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(output_dir, SUMMARY_FILENAME), 'w') as datafile:
+        json.dump(results, datafile, indent=2, sort_keys=True)
+
+    return results
+
+
+#the progress output of several tasks at once would be unreadable, so only the parent process prints anything
+def init_worker():
+    sys.stdout = open(os.devnull, 'w')
+
+
+#print a table with a row for every result, followed by the parameters named in names
+#columns is a list of (heading, width, format, value_func). a negative width left aligns the column, and format is a % conversion without the width, like '.2f'
+def print_summary(results, columns, names):
+    print " ".join("%*s"%(width, heading) for heading, width, _, _ in columns) + "  parameters"
+    for result in results:
+        print " ".join(("%*" + value_format)%(width, value_func(result)) for _, width, value_format, value_func in columns) + "  " + describe_params(result['params'], names)
@@ -13,6 +13,10 @@ import math
 class Vector3D(tuple):
     def __new__(cls, x,y,z):
         return tuple.__new__(cls,(x,y,z))
+    
+    #tuple's version of this passes a single tuple to __new__, which breaks pickle protocol 2 and multiprocessing
+    def __getnewargs__(self):
+        return tuple(self)
         
     def __add__(self, other):
         return Vector3D(self[0] + other[0], self[1] + other[1], self[2] + other[2])
@@ -0,0 +1,24 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+This file is responsible for splitting work that can be done with map() between several processes
+'''
+
+import multiprocessing
+from contextlib import contextmanager
+
+#use as "with worker_map(workers) as map_func:". map_func works like map, but with more than one worker it runs each item in whichever process is free
+#the processes are shut down when the with block ends, even if it raised
+@contextmanager
+def worker_map(workers):
+    if(workers > 1):
+        pool = multiprocessing.Pool(workers)
+        try:
+            yield pool.map
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        yield map